@@ -1,9 +1,12 @@
 # api_client.py (精简后)
 # ... (保留所有 import 和 get_device_hash, is_running_in_vm 函数) ...
 
+import time
 from typing import Optional
 import httpx
+from jose import jwt
 
+from license_token import MIN_CHECK_INTERVAL_SECS
 from widgets.utils import get_device_hash
 
 # --- 配置 ---
@@ -18,6 +21,31 @@ class ApiClient(object):
         self.tool_code = None
         self.order_id = None  # 用于存储订单ID
         self.device_hash = get_device_hash()  # 获取当前设备的唯一标识符
+        self._validators = {}  # (接口, order_id) -> (ETag, 令牌), 用于条件请求
+
+    def _conditional_headers(self, path: str) -> dict:
+        """订单未变化时服务器返回 304, 沿用缓存的令牌; 离线令牌临近 not_after 时不再发送 ETag 以换取新令牌"""
+        cached = self._validators.get((path, self.order_id))
+        if not cached:
+            return {}
+        etag, token_str = cached
+        not_after = jwt.get_unverified_claims(token_str).get("not_after")
+        if not_after and not_after - time.time() < 2 * MIN_CHECK_INTERVAL_SECS:
+            return {}
+        return {"If-None-Match": etag}
+
+    def _post_conditional(self, path: str):
+        """发送带 If-None-Match 的请求, 返回 (令牌, 响应); 304 时令牌取自缓存"""
+        response = httpx.post(f"{self.base_url}{path}", json={"order_id": self.order_id}, headers=self._conditional_headers(path))
+        if response.status_code == 304:
+            return self._validators[(path, self.order_id)][1], response
+        if response.status_code == 200:
+            token_str = response.json().get("data", {}).get("token")
+            if token_str and response.headers.get("ETag"):
+                self._validators[(path, self.order_id)] = (response.headers["ETag"], token_str)
+            return token_str, response
+        self._validators.pop((path, self.order_id), None)
+        return None, response
 
     def setup_totp(self, order_id: str) -> Optional[str]:
         """请求服务器生成TOTP URI"""
@@ -114,9 +142,9 @@ class ApiClient(object):
     def is_valid(self):
         """检查当前设备是否有效"""
         try:
-            response = httpx.post(f"{self.base_url}/order/is-valid", json={"order_id": self.order_id})
-            if response.status_code == 200:
-                return response.json()['data']['token'], None
+            token_str, response = self._post_conditional("/order/is-valid")
+            if response.status_code in (200, 304):
+                return token_str, None
             elif response.status_code < 500:
                 return None, response.json()['detail'][0]['msg']
             else:
@@ -146,11 +174,10 @@ class ApiClient(object):
 
     def check_subscription_status(self):
         try:
-            response = httpx.post(f"{self.base_url}/order/sub-check", json={"order_id": self.order_id})
-            token_str = response.json().get("data", {}).get("token")
-            if not token_str:
-                return None, "服务器未返回有效令牌"
-            if response.status_code == 200:
+            token_str, response = self._post_conditional("/order/sub-check")
+            if response.status_code in (200, 304):
+                if not token_str:
+                    return None, "服务器未返回有效令牌"
                 return token_str, None
             elif response.status_code < 500:
                 return None, response.json()['detail'][0]['msg']
@@ -0,0 +1,50 @@
+# license_token.py
+import time
+from pathlib import Path
+
+from jose import JWTError, jwt
+from jose.exceptions import JOSEError
+
+# 服务端 order_token.private_key_file 对应的公钥 (openssl ec -in order_es256.pem -pubout -out order_token_public.pem),
+# 与本文件放在同一目录, 打包时用 --include-data-files 带上; 没有公钥时 ES256 令牌一律校验失败
+ORDER_TOKEN_PUBLIC_KEY_FILE = Path(__file__).with_name("order_token_public.pem")
+ORDER_TOKEN_PUBLIC_KEY = ORDER_TOKEN_PUBLIC_KEY_FILE.read_text() if ORDER_TOKEN_PUBLIC_KEY_FILE.is_file() else None
+ORDER_TOKEN_ALGORITHM = "ES256"
+
+DEFAULT_CHECK_INTERVAL_SECS = 15 * 60  # 旧的对称令牌仍按 15 分钟联网检查
+MIN_CHECK_INTERVAL_SECS = 60
+
+
+def decode_order_token(token_str: str, tool_code: str, device_hash: str, order_id: str, email: str = None) -> dict:
+    """
+    解码服务端返回的订单令牌。
+    ES256 令牌用内置公钥离线校验签名和 not_after, 并确认令牌属于当前设备;
+    旧的 HS256 令牌仍用 tool_code + device_hash + order_id (+ email) 派生的密钥校验。
+    任何校验失败 (包括公钥缺失或格式错误) 都抛出 JWTError。
+    """
+    try:
+        if jwt.get_unverified_header(token_str).get("alg") == ORDER_TOKEN_ALGORITHM:
+            if not ORDER_TOKEN_PUBLIC_KEY:
+                raise JWTError(f"缺少订单令牌公钥 {ORDER_TOKEN_PUBLIC_KEY_FILE.name}")
+            token_data = jwt.decode(token_str, ORDER_TOKEN_PUBLIC_KEY, algorithms=[ORDER_TOKEN_ALGORITHM])
+            if token_data.get("tool_code") != tool_code or token_data.get("device_hash") != device_hash:
+                raise JWTError("令牌与当前设备不匹配")
+            return token_data
+
+        key_parts = [tool_code, device_hash, order_id]
+        if email is not None:
+            key_parts.append(email)
+        return jwt.decode(token_str, "_".join(key_parts), algorithms=["HS256"])
+    except JWTError:
+        raise
+    except (JOSEError, ValueError) as e:
+        # JWKError 等密钥错误不是 JWTError 的子类
+        raise JWTError(str(e)) from e
+
+
+def next_check_interval_secs(token_data: dict) -> int:
+    """离线令牌在 not_after 之前都可信, 只需在临近过期时联网刷新"""
+    not_after = token_data.get("not_after")
+    if not not_after:
+        return DEFAULT_CHECK_INTERVAL_SECS
+    return max(int(not_after - time.time()) - MIN_CHECK_INTERVAL_SECS, MIN_CHECK_INTERVAL_SECS)
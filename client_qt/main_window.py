@@ -1,9 +1,10 @@
 # client_qt/main_window.py
 from PySide6.QtWidgets import QMainWindow, QStackedWidget, QMessageBox
 from PySide6.QtCore import QThreadPool, Slot, QTimer  # QTimerを追加
-from jose import jwt, JWTError
+from jose.exceptions import JOSEError
 
 from api_client import ApiClient
+from license_token import decode_order_token, next_check_interval_secs
 from widgets.utils import is_running_in_vm
 
 from worker import Worker
@@ -110,11 +111,10 @@ class MainWindow(QMainWindow):
             return
 
         try:
-            secret_key = '_'.join((self.api.tool_code, self.api.device_hash, self.api.order_id))
-            decoded_token = jwt.decode(token_str, secret_key, algorithms=["HS256"])
+            decoded_token = decode_order_token(token_str, self.api.tool_code, self.api.device_hash, self.api.order_id)
             self.user_data = decoded_token  # 存储解码后的 token
             self.user_data['order_id'] = self.api.order_id  # 确保 order_id 也在 user_data 中
-        except JWTError as e:
+        except (JOSEError, ValueError) as e:
             self.show_error(f"令牌无效或已损坏: {e}")
             self.user_data['order_id'] = self.api.order_id
             self.show_page(self.setup_page)
@@ -218,10 +218,9 @@ class MainWindow(QMainWindow):
 
         try:
             # 解码 confirm_totp 返回的 token
-            secret_key = '_'.join((self.api.tool_code, self.api.device_hash, self.api.order_id, self.user_data['email']))
-            decoded_token = jwt.decode(token_str, secret_key, algorithms=["HS256"])
+            decoded_token = decode_order_token(token_str, self.api.tool_code, self.api.device_hash, self.api.order_id, self.user_data['email'])
             self.user_data.update(decoded_token)  # 更新 user_data
-        except JWTError as e:
+        except (JOSEError, ValueError) as e:
             self.show_error(f"首次绑定后的令牌解析失败: {e}")
             # 即使解析失败，也尝试进入主应用页，后续的心跳或操作会要求重新登录
 
@@ -330,15 +329,16 @@ class MainWindow(QMainWindow):
         # 所以解码时，order_id 应该是 rebind_target_order_id (即旧的那个，现在绑定到新设备了)
         # device_hash 是当前新设备的 self.api.device_hash
         try:
-            secret_key = '_'.join((self.api.tool_code, self.api.device_hash, self.rebind_target_order_id, self.user_data['email']))
-            decoded_token = jwt.decode(token_str, secret_key, algorithms=["HS256"])
+            decoded_token = decode_order_token(
+                token_str, self.api.tool_code, self.api.device_hash, self.rebind_target_order_id, self.user_data['email']
+            )
 
             # 更新 MainWindow 的核心状态
             self.api.order_id = self.rebind_target_order_id  # 非常重要：更新当前活动的 order_id
             self.user_data = decoded_token
             self.user_data['order_id'] = self.api.order_id  # 确保 user_data 也同步
 
-        except JWTError as e:
+        except (JOSEError, ValueError) as e:
             self.show_error(f"换绑后令牌解析失败: {e}")
             self.show_page(self.setup_page)
             self.setup_page.show_email_step()
@@ -366,13 +366,12 @@ class MainWindow(QMainWindow):
 
         # 登录成功，解码 token 并更新 user_data
         try:
-            secret_key = '_'.join((self.api.tool_code, self.api.device_hash, self.api.order_id, self.user_data['email']))
-            decoded_token = jwt.decode(token_str, secret_key, algorithms=["HS256"])
+            decoded_token = decode_order_token(token_str, self.api.tool_code, self.api.device_hash, self.api.order_id, self.user_data['email'])
             current_order_id = decoded_token.get('order_id', self.api.order_id)
             self.user_data=decoded_token  # 覆盖 user_data
             self.user_data['order_id'] = current_order_id  # 再次确保
             self.api.order_id = current_order_id  # 更新 api.order_id
-        except JWTError as e:
+        except (JOSEError, ValueError) as e:
             self.show_error(f"登录后令牌解析失败: {e}")
             # 即使解析失败，也可能需要一个不同的流程，或者强制重新setup
             return  # 停留在登录页或回到setup页
@@ -410,6 +409,12 @@ class MainWindow(QMainWindow):
         self.setup_login_page(mode="login")
 
     # --- 心跳逻辑 ---
+    def heartbeat_interval_ms(self) -> int:
+        """离线令牌 (带 not_after) 在有效期内无需心跳, 否则按固定间隔检查"""
+        if self.user_data.get('not_after'):
+            return max(next_check_interval_secs(self.user_data) * 1000, self.HEARTBEAT_INTERVAL_MS)
+        return self.HEARTBEAT_INTERVAL_MS
+
     @Slot()
     def on_script_started(self):
         """当 MainAppPage 中的脚本成功启动时调用"""
@@ -418,7 +423,7 @@ class MainWindow(QMainWindow):
             self.main_app_page.append_log("心跳检测已启动。")
         # 立即执行一次检查（可选，或者等待第一个 interval）
         self.perform_heartbeat_check()
-        self.heartbeat_timer.start(self.HEARTBEAT_INTERVAL_MS)
+        self.heartbeat_timer.start(self.heartbeat_interval_ms())
 
     @Slot()
     def on_script_stopped(self):
@@ -463,8 +468,9 @@ class MainWindow(QMainWindow):
 
         # 心跳检查成功，获得了新的 token_str
         try:
-            secret_key = '_'.join((self.api.tool_code, self.api.device_hash, self.api.order_id, self.user_data.get('email', '')))
-            new_decoded_token = jwt.decode(token_str, secret_key, algorithms=["HS256"])
+            new_decoded_token = decode_order_token(
+                token_str, self.api.tool_code, self.api.device_hash, self.api.order_id, self.user_data.get('email', '')
+            )
 
             # 更新 MainWindow 的 user_data
             self.user_data.update(new_decoded_token)
@@ -478,11 +484,11 @@ class MainWindow(QMainWindow):
 
             # 重启心跳计时器，进行下一次检查 (如果仍然 active)
             if self.heartbeat_timer.isActive():  # 如果上一次没被stop，则继续
-                self.heartbeat_timer.start(self.HEARTBEAT_INTERVAL_MS)
+                self.heartbeat_timer.start(self.heartbeat_interval_ms())
             elif self.main_app_page and self.main_app_page.is_script_active:  # 如果因为某种原因停了但脚本还在跑，重新启动
-                self.heartbeat_timer.start(self.HEARTBEAT_INTERVAL_MS)
+                self.heartbeat_timer.start(self.heartbeat_interval_ms())
 
-        except JWTError as e:
+        except (JOSEError, ValueError) as e:
             error_message = f"心跳检查成功但令牌解析失败: {e}"
             print(f"[Heartbeat] {error_message}")
             if self.main_app_page:
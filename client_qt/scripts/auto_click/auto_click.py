@@ -7,9 +7,10 @@ from PySide6.QtGui import QIntValidator
 from pynput import mouse, keyboard
 import time
 import datetime
-from jose import JWTError, jwt
+from jose.exceptions import JOSEError
 
 from api_client import ApiClient
+from license_token import decode_order_token, next_check_interval_secs
 
 WINDOW_TITLE = '自动点击器v1.0.0 - TopUtils'
 TOOL_CODE = '2ab2171ad8ba4521baf98ac5ff78a746'
@@ -159,7 +160,8 @@ class MainAppPage(QWidget):
             return
 
         expire_timestamp = token_data.get('expire_time')
-        rest_secs = token_data.get('rest_time')
+        # 剩余时间按 expire_time 在本地计算, 离线令牌在有效期内可以反复使用
+        rest_secs = expire_timestamp and expire_timestamp - time.time()
         reminder = token_data.get('reminder', False)
 
         if not expire_timestamp or rest_secs is None:
@@ -180,7 +182,7 @@ class MainAppPage(QWidget):
         else:
             self.auth_countdown_timer.start(1000)
 
-            check_interval_ms = min((self.remaining_auth_seconds - 1) * 1000, 15 * 60 * 1000)
+            check_interval_ms = min((self.remaining_auth_seconds - 1) * 1000, next_check_interval_secs(token_data) * 1000)
             if check_interval_ms > 0:
                 self.periodic_check_timer.start(check_interval_ms)
 
@@ -270,12 +272,11 @@ class MainAppPage(QWidget):
             self.log_output.append(f"定期状态检查API错误: {error or '未返回有效令牌'}")
             return
         try:
-            secret_key = '_'.join((self.api.tool_code, self.api.device_hash, self.api.order_id))
-            new_token_data = jwt.decode(new_token_str, secret_key, algorithms=["HS256"])
+            new_token_data = decode_order_token(new_token_str, self.api.tool_code, self.api.device_hash, self.api.order_id, self.user_email)
             self.log_output.append("授权状态已刷新。")
             self.auth_countdown_timer.stop()
             self.handle_authorization_status(new_token_data)
-        except JWTError as e:
+        except (JOSEError, ValueError) as e:
             self.log_output.append(f"刷新授权时令牌解析失败: {e}")
             self._handle_auth_expiration(message="授权信息刷新失败。")
 
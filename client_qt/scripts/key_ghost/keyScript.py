@@ -15,10 +15,11 @@ import ctypes.wintypes
 from PySide6.QtWidgets import QWidget, QVBoxLayout, QLabel, QTextEdit, QPushButton, QHBoxLayout, QLineEdit, QMessageBox, QComboBox, QRadioButton, QFormLayout
 from PySide6.QtCore import Qt, Signal, Slot, QThread, QTimer
 from PySide6.QtGui import QDoubleValidator
-from jose import jwt, JWTError
+from jose.exceptions import JOSEError
 from pynput import keyboard
 
 from api_client import ApiClient
+from license_token import decode_order_token, next_check_interval_secs
 from worker import Worker
 
 # --- 配置 ---
@@ -341,7 +342,8 @@ class MainAppPage(QWidget):
             return
 
         expire_timestamp = token_data.get('expire_time')
-        rest_secs = token_data.get('rest_time')
+        # 剩余时间按 expire_time 在本地计算, 离线令牌在有效期内可以反复使用
+        rest_secs = expire_timestamp and expire_timestamp - time.time()
         reminder = token_data.get('reminder', False)
 
         if not expire_timestamp or rest_secs is None:
@@ -360,7 +362,7 @@ class MainAppPage(QWidget):
             self._handle_auth_expiration(initial_check=True)
         else:
             self.auth_countdown_timer.start(1000)
-            check_interval_ms = min((self.remaining_auth_seconds - 1) * 1000, 15 * 60 * 1000)
+            check_interval_ms = min((self.remaining_auth_seconds - 1) * 1000, next_check_interval_secs(token_data) * 1000)
             if check_interval_ms > 0:
                 self.periodic_check_timer.start(check_interval_ms)
             self._update_auth_status_display(reminder)
@@ -442,12 +444,11 @@ class MainAppPage(QWidget):
             self.append_log(f"定期状态检查API错误: {error or '未返回有效令牌'}")
             return
         try:
-            secret_key = '_'.join((self.api.tool_code, self.api.device_hash, self.api.order_id))
-            new_token_data = jwt.decode(new_token_str, secret_key, algorithms=["HS256"])
+            new_token_data = decode_order_token(new_token_str, self.api.tool_code, self.api.device_hash, self.api.order_id, self.user_email)
             self.append_log("授权状态已刷新。")
             self.auth_countdown_timer.stop()
             self.handle_authorization_status(new_token_data)
-        except JWTError as e:
+        except (JOSEError, ValueError) as e:
             self.append_log(f"刷新授权时令牌解析失败: {e}")
             self._handle_auth_expiration(message="授权信息刷新失败。")
 
@@ -1,8 +1,76 @@
-from server.config.settings import HTTP_HOST, HTTP_PORT
+import os
+import time
 
+_config_loaded_at = time.perf_counter()
+
+from server.config.settings import (  # noqa: E402
+    BASE_DIR,
+    GUNICORN_GRACEFUL_TIMEOUT,
+    GUNICORN_KEEPALIVE,
+    GUNICORN_MAX_REQUESTS,
+    GUNICORN_MAX_REQUESTS_JITTER,
+    GUNICORN_TIMEOUT,
+    GUNICORN_WORKERS,
+    HTTP_HOST,
+    HTTP_PORT,
+    METRICS_DIR,
+)
 
 bind = f'{HTTP_HOST}:{HTTP_PORT}'
-worker_class = 'uvicorn.workers.UvicornWorker'
+worker_class = 'server.config.workers.UvloopUvicornWorker'
+
+# 设置 Gunicorn 的 worker 数量, 未配置时每个 CPU 一个异步 worker
+workers = GUNICORN_WORKERS or os.cpu_count() or 1
+
+# 在 master 中导入应用一次, 模块导入和 pydantic 模型创建不在每个 worker 中重复, 并与 worker 共享内存页
+preload_app = True
+
+# 每个 worker 处理一定数量的请求后重启, 加上随机抖动避免所有 worker 同时重启
+max_requests = GUNICORN_MAX_REQUESTS
+max_requests_jitter = GUNICORN_MAX_REQUESTS_JITTER
+timeout = GUNICORN_TIMEOUT
+graceful_timeout = GUNICORN_GRACEFUL_TIMEOUT  # 收到重启/停止信号后等待进行中的请求完成的时间
+keepalive = GUNICORN_KEEPALIVE
+
+# worker 心跳文件放在内存文件系统中, 避免磁盘 I/O 阻塞心跳
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Prometheus 多进程模式: 每个 worker 把指标写到该目录, /metrics 汇总; 必须在预加载应用 (导入 prometheus_client) 之前设置
+os.environ['PROMETHEUS_MULTIPROC_DIR'] = METRICS_DIR
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+# 以 --daemon 运行时 gunicorn 自身的日志 (包括 worker 启动耗时) 写到这里
+errorlog = str(BASE_DIR / 'logs' / 'gunicorn.log')
+loglevel = 'info'
+
+
+def on_starting(server):
+    from server.config.request_metrics import prepare_metrics_dir
+
+    # 清掉上次运行留下的指标文件, 只在 master 启动时执行一次, HUP 重载不清空
+    prepare_metrics_dir(METRICS_DIR)
+
+
+def when_ready(server):
+    from server.config.workers import startup_logger
+    from server.module.common.global_variable import start_log_listener
+
+    # 预加载应用时不启动监听线程, master 完成 daemonize 后再启动, worker 各自在应用 startup 事件中启动
+    start_log_listener()
+    startup_logger.info(f'Application preloaded in {time.perf_counter() - _config_loaded_at:.3f} seconds')
+
+
+def post_fork(server, worker):
+    from server.config.workers import log_worker_ready, mark_worker_forked
+
+    mark_worker_forked()
+    # 最后一个 startup 事件, 其他 startup 事件都完成后才算 worker 就绪; 只在 gunicorn 下注册, 应用本身不导入 gunicorn / uvicorn.workers
+    server.app.wsgi().add_event_handler('startup', log_worker_ready)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
 
-# 设置 Gunicorn 的 worker 数量
-workers = 2
+    # 退出的 worker 不再计入 http_requests_in_flight, 计数器和直方图保留
+    multiprocess.mark_process_dead(worker.pid)
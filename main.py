@@ -10,4 +10,5 @@ if not DEBUG:
     app.add_middleware(LogMiddleware)
 
 if __name__ == '__main__':
+    # 本地调试用 uvicorn 默认的 loop='auto', 没有安装 uvloop 时退回 asyncio; 生产环境由 gunicorn worker 指定 uvloop
     uvicorn.run(app, port=HTTP_PORT)
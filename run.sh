@@ -1,4 +1,8 @@
 git pull
 aerich upgrade
 # gunicorn -c gunicorn_config.py main:app
-gunicorn -c gunicorn_config.py main:app --daemon
\ No newline at end of file
+gunicorn -c gunicorn_config.py main:app --daemon
+# 发件箱消费进程, 只保留一个实例
+pkill -f server.module.common.email_worker
+while pgrep -f server.module.common.email_worker > /dev/null; do sleep 1; done
+nohup python -m server.module.common.email_worker >> logs/email_worker.log 2>&1 &
\ No newline at end of file
@@ -2,21 +2,28 @@ import os
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from tortoise.contrib.fastapi import register_tortoise
 
-from server.config.settings import BASE_DIR, DEBUG, DEFAULT_AVATAR_PATH, TORTOISE_ORM
+from server.config.metrics import METRICS_PATH, MetricsMiddleware, metrics_endpoint
+from server.config.settings import BASE_DIR, DEBUG, DEFAULT_AVATAR_PATH, TORTOISE_ORM, print_db_banner
+from server.config.static_files import CachedStaticFiles
+from server.module.common.file_utils import shutdown_thumbnail_executor
+from server.module.common.global_variable import FastJSONResponse, start_log_listener, stop_log_listener
+from server.module.common.parameter_cache import start_param_invalidation_listener, stop_param_invalidation_listener
+from server.module.user.utils import start_last_seen_flusher, stop_last_seen_flusher
 
 
 def create_app():
+    print_db_banner()
+    # 默认用 orjson 序列化响应
     if DEBUG:
-        app = FastAPI()
+        app = FastAPI(default_response_class=FastJSONResponse)
     else:
-        app = FastAPI(docs_url=None, redoc_url=None)
+        app = FastAPI(docs_url=None, redoc_url=None, default_response_class=FastJSONResponse)
 
     app.mount(
         "/static",
-        StaticFiles(directory=DEFAULT_AVATAR_PATH),
+        CachedStaticFiles(directory=DEFAULT_AVATAR_PATH),
         name="static",
     )
     origins = [
@@ -33,6 +40,19 @@ def create_app():
         allow_headers=["*"],
         # expose_headers=["*"],
     )
+    # 在 CORS 外层, 预检请求也计入; /metrics 不对外暴露, 需在反向代理上限制访问
+    app.add_middleware(MetricsMiddleware)
+    app.add_api_route(METRICS_PATH, metrics_endpoint, include_in_schema=False)
+
+    # 每个 worker 进程各自的日志监听线程, 最后一个停止
+    app.add_event_handler("startup", start_log_listener)
+    # tortoise 的 lifespan 包在所有事件处理器外层: 关闭时先写完缓冲的最后访问信息, 再断开数据库连接
+    app.add_event_handler("startup", start_last_seen_flusher)
+    app.add_event_handler("shutdown", stop_last_seen_flusher)
+    # 订阅系统参数的失效通知, 清除本 worker 的进程内缓存
+    app.add_event_handler("startup", start_param_invalidation_listener)
+    app.add_event_handler("shutdown", stop_param_invalidation_listener)
+    app.add_event_handler("shutdown", shutdown_thumbnail_executor)
 
     register_tortoise(
         app,
@@ -40,6 +60,7 @@ def create_app():
         # generate_schemas=True,
         add_exception_handlers=True,
     )
+    app.add_event_handler("shutdown", stop_log_listener)
 
     return app
 
@@ -0,0 +1,100 @@
+"""
+带连接池统计的 asyncpg 后端, 在 TORTOISE_ORM 中作为 engine 使用:
+
+    "engine": "server.config.db_backend"
+
+统计按 worker 进程、按连接名分别记录, 用于对照 gunicorn worker 数量调整连接池大小。
+事务之外每条查询借还一次连接, 借出到归还的耗时同时计入当前请求的查询数和查询耗时 (/metrics)。
+"""
+
+import time
+from typing import Any
+
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from tortoise.backends.base.client import PoolConnectionWrapper
+
+from server.config.request_metrics import record_db_query
+
+# connection_name -> client, 本进程内创建过的所有连接
+_clients: dict[str, 'InstrumentedAsyncpgDBClient'] = {}
+
+
+class PoolStats:
+    """一个连接池在本进程内的获取/占用统计"""
+
+    def __init__(self) -> None:
+        self.acquires = 0
+        self.waiters = 0  # 正在等待空闲连接的调用数
+        self.in_use = 0  # 已借出未归还的连接数
+        self.acquire_wait_seconds_total = 0.0
+        self.acquire_wait_seconds_max = 0.0
+        self.hold_seconds_total = 0.0
+
+    def snapshot(self, pool) -> dict[str, Any]:
+        stats = {
+            'acquires': self.acquires,
+            'waiters': self.waiters,
+            'in_use': self.in_use,
+            'acquire_wait_ms_avg': self.acquire_wait_seconds_total / self.acquires * 1000 if self.acquires else 0.0,
+            'acquire_wait_ms_max': self.acquire_wait_seconds_max * 1000,
+            'hold_ms_avg': self.hold_seconds_total / self.acquires * 1000 if self.acquires else 0.0,
+        }
+        if pool is not None:
+            stats.update(
+                size=pool.get_size(),
+                idle=pool.get_idle_size(),
+                min_size=pool.get_min_size(),
+                max_size=pool.get_max_size(),
+            )
+        return stats
+
+
+class InstrumentedPoolConnectionWrapper(PoolConnectionWrapper):
+    __slots__ = ('acquire_started_at', 'acquired_at')
+
+    async def __aenter__(self):
+        stats: PoolStats = self.client.pool_stats
+        await self.ensure_connection()
+        self.acquire_started_at = time.perf_counter()
+        stats.waiters += 1
+        try:
+            self.connection = await self.client._pool.acquire()
+        finally:
+            stats.waiters -= 1
+        self.acquired_at = time.perf_counter()
+        wait = self.acquired_at - self.acquire_started_at
+        stats.acquires += 1
+        stats.in_use += 1
+        stats.acquire_wait_seconds_total += wait
+        stats.acquire_wait_seconds_max = max(stats.acquire_wait_seconds_max, wait)
+        return self.connection
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        stats: PoolStats = self.client.pool_stats
+        try:
+            await super().__aexit__(exc_type, exc_val, exc_tb)
+        finally:
+            released_at = time.perf_counter()
+            stats.in_use -= 1
+            stats.hold_seconds_total += released_at - self.acquired_at
+            record_db_query(released_at - self.acquire_started_at)
+
+
+class InstrumentedAsyncpgDBClient(AsyncpgDBClient):
+    """事务之外的连接获取都经过 InstrumentedPoolConnectionWrapper 计时"""
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.pool_stats = PoolStats()
+        _clients[self.connection_name] = self
+
+    def acquire_connection(self):
+        return InstrumentedPoolConnectionWrapper(self, self._pool_init_lock)
+
+
+def get_pool_stats() -> dict[str, dict[str, Any]]:
+    """本进程内各个连接池的实时统计, {连接名: 统计}"""
+    return {name: client.pool_stats.snapshot(client._pool) for name, client in _clients.items()}
+
+
+client_class = InstrumentedAsyncpgDBClient
@@ -0,0 +1,105 @@
+"""
+Prometheus 指标, 由 GET /metrics 输出。
+
+gunicorn 下以多进程模式运行: gunicorn_config 在导入应用前设置 PROMETHEUS_MULTIPROC_DIR,
+每个 worker 把指标写到该目录下以 pid 区分的 mmap 文件, /metrics 汇总目录中所有文件 (包括已退出的 worker),
+请求落到哪个 worker 结果都一样。发件箱进程的 SMTP 指标写在子目录中, 一并汇总。
+没有设置该环境变量时 (fastapi dev / uvicorn 单进程) 使用进程内的默认注册表。
+
+数据库查询和 Redis 往返先累加到请求自己的 RequestMetrics 中, 请求结束时按路由写一次指标,
+每次查询只多一次属性累加。
+"""
+
+import asyncio
+import os
+import time
+from pathlib import Path
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from server.config.request_metrics import EMAIL_WORKER_METRICS_SUBDIR, RequestMetrics, current_request_metrics
+
+METRICS_PATH = '/metrics'
+UNMATCHED_ROUTE = '<unmatched>'  # 未匹配任何路由的请求 (404 等) 合并为一个标签值, 避免按原始路径产生无限多的时间序列
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['method', 'route'], buckets=LATENCY_BUCKETS)
+REQUESTS = Counter('http_requests', 'HTTP responses by status code', ['method', 'route', 'status'])
+IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests being handled', multiprocess_mode='livesum')
+DB_QUERIES = Counter('db_queries', 'Database queries issued by requests', ['route'])
+DB_QUERY_SECONDS = Counter('db_query_seconds', 'Time requests spent in database queries, including pool waits', ['route'])
+REDIS_ROUND_TRIPS = Counter('redis_round_trips', 'Redis round trips made by requests', ['route'])
+PASSWORD_HASH_QUEUE_SECONDS = Histogram(
+    'password_hash_queue_seconds',
+    'Time password hashing calls waited for a free hashing thread',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+PASSWORD_HASH_REJECTED = Counter('password_hash_rejected', 'Password hashing calls rejected with 429 because the queue was full')
+
+
+def route_label(scope: Scope) -> str:
+    """路由模板 (如 /api/order/is-valid), 挂载的子应用为挂载路径 (如 /static)"""
+    route = scope.get('route')
+    if route is not None:
+        return route.path
+    return scope.get('root_path') or UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """纯 ASGI 中间件: 记录请求耗时、状态码、进行中的请求数, 以及请求内的数据库 / Redis 开销"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500  # 异常未生成响应时由外层返回 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        request_metrics = RequestMetrics()
+        token = current_request_metrics.set(request_metrics)
+        IN_FLIGHT.inc()
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start_time
+            IN_FLIGHT.dec()
+            current_request_metrics.reset(token)
+            # 路由在应用内部匹配后才写入 scope
+            route = route_label(scope)
+            REQUEST_LATENCY.labels(scope['method'], route).observe(elapsed)
+            REQUESTS.labels(scope['method'], route, str(status_code)).inc()
+            if request_metrics.db_queries:
+                DB_QUERIES.labels(route).inc(request_metrics.db_queries)
+                DB_QUERY_SECONDS.labels(route).inc(request_metrics.db_seconds)
+            if request_metrics.redis_round_trips:
+                REDIS_ROUND_TRIPS.labels(route).inc(request_metrics.redis_round_trips)
+
+
+def _collect() -> bytes:
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if not multiproc_dir:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, multiproc_dir)
+    email_worker_dir = Path(multiproc_dir) / EMAIL_WORKER_METRICS_SUBDIR
+    if email_worker_dir.is_dir():
+        multiprocess.MultiProcessCollector(registry, str(email_worker_dir))
+    return generate_latest(registry)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    # 多进程模式下要读所有 worker 的指标文件, 放到线程中执行
+    return Response(await asyncio.to_thread(_collect), media_type=CONTENT_TYPE_LATEST)
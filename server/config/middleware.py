@@ -1,46 +1,71 @@
 import time
-from fastapi import Request, Response, status
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi import Response, status
+from jose import JWTError, jwt
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from server.config.settings import DEBUG, DEV
 from server.module.common.global_variable import access_logger, error_logger
-from server.module.user.utils import validate_token
 
 
-class LogMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
+def get_request_identity(scope: Scope) -> tuple[str, str]:
+    """
+    获取请求的用户名和角色, 仅用于日志。
+    优先使用 current_user 放在 request.state 中的 token 信息, 否则只解析 token 的 claims, 不做任何 I/O。
+    """
+    user_base_info = scope.get('state', {}).get('user_base_info')
+    if not user_base_info:
+        token = dict(scope['headers']).get(b'authorization')
+        if not token:
+            return 'anonymous', 'unknown'
+        try:
+            user_base_info = jwt.get_unverified_claims(token.decode('latin-1').split()[-1])
+        except (JWTError, IndexError):
+            return 'anonymous', 'unknown'
+    return user_base_info.get('username', 'anonymous'), user_base_info.get('role', 'unknown')
 
-        # 获取请求的 IP 地址
-        client_ip = request.client.host
 
-        # 获取当前用户信息（假设已经通过依赖注入获取了用户）
-        token = request.headers.get('authorization')
-        try:
-            user = await validate_token(token.split()[-1])
-            username = user['username']
-        except Exception:
-            # from traceback import print_exc
-            # print_exc()
-            username = "anonymous"
-            role = 'unknown'
+class LogMiddleware:
+    """纯 ASGI 访问日志中间件, 不像 BaseHTTPMiddleware 那样为每个响应额外包一层 task 和 stream"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
 
-        # access_logger.info(f"Incoming request from user: {username}[{role}] at {client_ip} - {request.method} {request.url.path}")
+        start_time = time.perf_counter()
+        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        response_started = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code, response_started
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                response_started = True
+            await send(message)
+
+        # 获取请求的 IP 地址
+        client_ip = scope['client'][0] if scope.get('client') else 'unknown'
 
         try:
-            response = await call_next(request)
+            await self.app(scope, receive, send_wrapper)
         except Exception as e:
             from traceback import format_exc, print_exc
 
-            err_msg = f"Error handling request from user: {username}[{role}] at {client_ip} - {request.method} {request.url.path} - {format_exc()}"
+            username, role = get_request_identity(scope)
+            err_msg = f"Error handling request from user: {username}[{role}] at {client_ip} - {scope['method']} {scope['path']} - {format_exc()}"
             if DEBUG or DEV:
                 print_exc()
                 print(err_msg, e)
 
             error_logger.error(err_msg)
-            return Response("Internal Server Error", status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            if not response_started:
+                response = Response("Internal Server Error", status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                await response(scope, receive, send)
+            return
 
+        username, role = get_request_identity(scope)
         access_logger.info(
-            f"Completed request from user: {username}[{role}] at {client_ip} - {request.method} {request.url.path} in {time.time() - start_time:.4f} seconds code: {response.status_code}"
+            f"Completed request from user: {username}[{role}] at {client_ip} - {scope['method']} {scope['path']} in {time.perf_counter() - start_time:.4f} seconds code: {status_code}"
         )
-
-        return response
@@ -0,0 +1,45 @@
+"""
+请求内的数据库查询 / Redis 往返计数, 由 MetricsMiddleware 在请求结束时按路由写入 Prometheus 指标。
+
+本模块不导入 prometheus_client: 多进程模式下必须先设置 PROMETHEUS_MULTIPROC_DIR 再导入它,
+数据库后端、RedisCache、gunicorn 配置和发件箱进程都可以先导入本模块。
+"""
+
+from contextvars import ContextVar
+from pathlib import Path
+
+EMAIL_WORKER_METRICS_SUBDIR = 'email_worker'  # 发件箱进程的指标文件子目录
+
+
+class RequestMetrics:
+    __slots__ = ('db_queries', 'db_seconds', 'redis_round_trips')
+
+    def __init__(self) -> None:
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.redis_round_trips = 0
+
+
+# 请求之外 (后台任务、发件箱进程) 为 None, 不计数
+current_request_metrics: ContextVar[RequestMetrics | None] = ContextVar('current_request_metrics', default=None)
+
+
+def record_db_query(seconds: float) -> None:
+    request_metrics = current_request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.db_queries += 1
+        request_metrics.db_seconds += seconds
+
+
+def record_redis_round_trip() -> None:
+    request_metrics = current_request_metrics.get()
+    if request_metrics is not None:
+        request_metrics.redis_round_trips += 1
+
+
+def prepare_metrics_dir(directory: str | Path) -> None:
+    """创建多进程指标目录并删除上次运行留下的指标文件, 只在写入该目录的进程启动前调用"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for path in directory.glob('*.db'):
+        path.unlink(missing_ok=True)
@@ -1,5 +1,4 @@
 from fastapi import FastAPI
-from tortoise import Tortoise
 
 from server.config.settings import DEBUG
 from server.module.common.apis import router as common_router
@@ -13,16 +12,8 @@ def register_router(app: FastAPI):
     register router to app
     """
 
-    Tortoise.init_models(
-        [
-            'server.module.common.models',
-            'server.module.user.models',
-            'server.module.order.models',
-            'server.module.tool.models',
-        ],
-        'models',
-    )
-
+    # 模型关系由 register_tortoise 在 startup 时的 Tortoise.init 解析, ORM pydantic 模型在首次使用时才创建,
+    # 这里不再提前 init_models
     if DEBUG:
         app.include_router(
             debug_router,
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 import yaml
 
@@ -7,9 +8,11 @@ BASE_DIR = Path(__file__).resolve().parent.parent.parent
 STATIC_PATH = BASE_DIR / "server" / "statics"
 DEFAULT_AVATAR_PATH = STATIC_PATH / "avatar"
 
-# Load YAML configuration
-with open(BASE_DIR / "config.yaml", "r") as f:
-    config = yaml.safe_load(f)
+# Load YAML configuration, TOPUTILS_CONFIG 可以指定其他配置文件 (测试使用 config.example.yaml)
+CONFIG_PATH = Path(os.environ.get("TOPUTILS_CONFIG") or BASE_DIR / "config.yaml")
+with open(CONFIG_PATH, "r") as f:
+    # libyaml 的 C 实现解析快一个数量级, 没有编译 libyaml 时退回纯 Python 实现
+    config = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
 # Assign variables from YAML
 DEBUG = config.get("DEBUG", False)
@@ -24,11 +27,28 @@ PG_USER = config["database"]["user"]
 PG_PASS = config["database"]["password"]
 PG_DB = config["database"]["name"]
 DB_URL = f"postgres://{PG_USER}:{PG_PASS}@{PG_HOST}:{PG_PORT}/{PG_DB}"
+# 每个 worker 进程一个连接池, 总连接数为 maxsize * worker 数, 需小于 Postgres 的 max_connections
+PG_POOL = {
+    "minsize": config["database"].get("pool", {}).get("minsize", 1),
+    "maxsize": config["database"].get("pool", {}).get("maxsize", 5),
+    "max_queries": config["database"].get("pool", {}).get("max_queries", 50000),  # 连接执行这么多条查询后重建
+    "max_inactive_connection_lifetime": config["database"].get("pool", {}).get("max_inactive_connection_lifetime", 300.0),
+    "statement_cache_size": config["database"].get("pool", {}).get("statement_cache_size", 100),  # 经过 pgbouncer 事务模式时设为 0
+}
+# 只读副本, 未配置的项与主库相同; 不配置时所有查询走主库
+PG_REPLICA = config["database"].get("replica") or {}
+REPLICA_ENABLED = bool(PG_REPLICA.get("host"))
+REPLICA_STICKY_SECONDS = PG_REPLICA.get("sticky_seconds", 5)  # 写入后这么多秒内同一订单/用户的读取仍走主库, 需大于复制延迟
+
+
+
+def print_db_banner():
+    """提示当前使用的数据库, 由 create_app 调用一次, 导入 settings 的脚本和子进程不再打印"""
+    if PG_DB.endswith('_test'):
+        print('-' * 10, 'db', '-' * 10, f"Using \033[92m{PG_DB} \033[0m now...")
+    else:
+        print('-' * 10, 'db', '-' * 10, f"\033[91mWarning!!!\033[0m using production DB: \033[91m{PG_DB}\033[0m now")
 
-if PG_DB.endswith('_test'):
-    print('-' * 10, 'db', '-' * 10, f"Using \033[92m{PG_DB} \033[0m now...")
-else:
-    print('-' * 10, 'db', '-' * 10, f"\033[91mWarning!!!\033[0m using production DB: \033[91m{PG_DB}\033[0m now")
 
 # Redis settings
 REDIS_HOST = config["redis"]["host"]
@@ -38,12 +58,37 @@ REDIS_PASS = config["redis"]["password"]
 REDIS_DB = config["redis"]["db"]
 REDIS_URL = f"redis://{REDIS_USER}:{REDIS_PASS}@{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
 CACHE_HEADER = "tutil.cache."
+REDIS_MAX_CONNECTIONS = config["redis"].get("max_connections", 50)  # 每个 worker 进程的连接池上限
+REDIS_HEALTH_CHECK_INTERVAL = config["redis"].get("health_check_interval", 30)  # 连接空闲超过该秒数才在使用前 PING
+REDIS_SOCKET_TIMEOUT = config["redis"].get("socket_timeout", 5)
 
 # HTTP settings
 HTTP_HOST = config["http"]["host"]
 HTTP_PORT = config["http"]["port"]
 HTTP_ADDR = f"http://{HTTP_HOST}:{HTTP_PORT}"
 
+# Gunicorn settings
+GUNICORN_WORKERS = config.get("gunicorn", {}).get("workers", 0)  # 0: 按 CPU 数量
+GUNICORN_MAX_REQUESTS = config.get("gunicorn", {}).get("max_requests", 10000)
+GUNICORN_MAX_REQUESTS_JITTER = config.get("gunicorn", {}).get("max_requests_jitter", 1000)
+GUNICORN_TIMEOUT = config.get("gunicorn", {}).get("timeout", 30)
+GUNICORN_GRACEFUL_TIMEOUT = config.get("gunicorn", {}).get("graceful_timeout", 30)
+GUNICORN_KEEPALIVE = config.get("gunicorn", {}).get("keepalive", 5)
+
+# Log settings
+LOG_JSON = config.get("log", {}).get("json", False)  # 以 JSON Lines 格式写日志
+LOG_QUEUE_SIZE = config.get("log", {}).get("queue_size", 10000)  # 日志队列满时丢弃新日志, 不阻塞请求
+LOG_COMPRESS = config.get("log", {}).get("compress", True)  # 轮转后的日志文件 gzip 压缩
+
+# Metrics settings
+# gunicorn 多进程模式的指标文件目录, 相对路径基于项目根目录
+METRICS_DIR = str(BASE_DIR / config.get("metrics", {}).get("multiproc_dir", "logs/metrics"))
+
+# Upload settings
+AVATAR_MAX_SIZE = config.get("upload", {}).get("avatar_max_size", 5 * 1024 * 1024)  # 头像上传大小上限, 字节
+AVATAR_THUMBNAIL_SIZES = config.get("upload", {}).get("avatar_thumbnail_sizes", [64, 256])  # 缩略图边长, 像素
+THUMBNAIL_WORKERS = config.get("upload", {}).get("thumbnail_workers", 2)  # 每个 worker 生成缩略图的进程数
+
 # Mail settings
 MAIL_SECRET = config["yeah_mail"]["secret"]
 MAIL_FROM = config["yeah_mail"]["from"]
@@ -52,22 +97,48 @@ MAIL_PORT = config["yeah_mail"]["port"]
 MAIL_SERVER = config["yeah_mail"]["server"]
 MAIL_STARTTLS = config["yeah_mail"].get("starttls", False)
 MAIL_SSL_TLS = config["yeah_mail"].get("ssl_tls", True)
+MAIL_OUTBOX_BATCH_SIZE = config["yeah_mail"].get("outbox_batch_size", 20)  # 一次 SMTP 连接内最多连续发送的邮件数
+MAIL_MAX_RETRIES = config["yeah_mail"].get("max_retries", 5)
+MAIL_IDLE_TIMEOUT = config["yeah_mail"].get("idle_timeout", 60)  # 空闲多少秒后断开 SMTP 长连接
 
 
 # JWT and other settings
 ALGORITHM = config.get("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_DAYS = config.get("ACCESS_TOKEN_EXPIRE_DAYS", 7)
 
+# Password hashing settings, argon2 parameters come from `python -m server.module.user.calibrate_password`
+PASSWORD_HASH_WORKERS = config.get("password_hash", {}).get("workers", 2)  # threads per worker process
+PASSWORD_HASH_MAX_PENDING = config.get("password_hash", {}).get("max_pending", 32)  # beyond this requests get 429
+PASSWORD_HASH_PARAMS = {
+    f"argon2__{name}": config["password_hash"][name]
+    for name in ("time_cost", "memory_cost", "parallelism")
+    if name in config.get("password_hash", {})
+}
+
+# Order license token settings
+# 配置了私钥时订单令牌改用非对称签名, 客户端用打包进去的公钥文件即可离线校验; 不配置时沿用 ALGORITHM
+ORDER_TOKEN_CONFIG = config.get("order_token") or {}
+ORDER_TOKEN_ALGORITHM = ORDER_TOKEN_CONFIG.get("algorithm", ALGORITHM)
+ORDER_TOKEN_LIFETIME_HOURS = ORDER_TOKEN_CONFIG.get("lifetime_hours", 6)
+ORDER_TOKEN_PRIVATE_KEY = None
+if ORDER_TOKEN_CONFIG.get("private_key_file"):
+    with open(BASE_DIR / ORDER_TOKEN_CONFIG["private_key_file"], "r") as f:
+        ORDER_TOKEN_PRIVATE_KEY = f.read()
+elif ORDER_TOKEN_ALGORITHM != ALGORITHM:
+    raise ValueError(f"order_token.private_key_file is required for {ORDER_TOKEN_ALGORITHM} order tokens")
+
 TORTOISE_ORM = {
     "connections": {
         "default": {
-            "engine": "tortoise.backends.asyncpg",
+            # tortoise.backends.asyncpg 加上连接池统计
+            "engine": "server.config.db_backend",
             "credentials": {
                 "host": PG_HOST,
                 "port": PG_PORT,
                 "user": PG_USER,
                 "password": PG_PASS,
                 "database": PG_DB,
+                **PG_POOL,
             },
         }
     },
@@ -86,3 +157,17 @@ TORTOISE_ORM = {
     "use_tz": True,
     "timezone": "UTC",
 }
+
+if REPLICA_ENABLED:
+    TORTOISE_ORM["connections"]["replica"] = {
+        "engine": "server.config.db_backend",
+        "credentials": {
+            "host": PG_REPLICA["host"],
+            "port": PG_REPLICA.get("port", PG_PORT),
+            "user": PG_REPLICA.get("user", PG_USER),
+            "password": PG_REPLICA.get("password", PG_PASS),
+            "database": PG_REPLICA.get("name", PG_DB),
+            **PG_POOL,
+            **PG_REPLICA.get("pool", {}),
+        },
+    }
@@ -0,0 +1,99 @@
+"""
+冷启动分析, 在项目根目录运行:
+
+    python -m server.config.startup_profile              # 导入耗时排名 + 导入 main 的冷启动基准
+    python -m server.config.startup_profile --lifespan   # 基准中加上 startup 事件, 需要能连上数据库和 Redis
+
+每一轮都在新的解释器中执行, 结果与 gunicorn 启动一个新 worker (未开启 preload_app 时) 的开销一致。
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+# 在子进程中执行, 输出一行 json: 导入 main 的耗时, 以及 (可选) lifespan startup 的耗时
+BENCHMARK_CODE = """
+import asyncio, json, sys, time
+
+start = time.perf_counter()
+from main import app
+result = {'import': time.perf_counter() - start}
+
+async def run_lifespan():
+    receive_queue = asyncio.Queue()
+    started = asyncio.Event()
+
+    async def send(message):
+        if message['type'].startswith('lifespan.startup'):
+            if message['type'] == 'lifespan.startup.failed':
+                print(message.get('message'), file=sys.stderr)
+            started.set()
+
+    await receive_queue.put({'type': 'lifespan.startup'})
+    begin = time.perf_counter()
+    task = asyncio.create_task(app({'type': 'lifespan', 'asgi': {'version': '3.0'}, 'state': {}}, receive_queue.get, send))
+    await started.wait()
+    result['startup'] = time.perf_counter() - begin
+    await receive_queue.put({'type': 'lifespan.shutdown'})
+    await task
+
+if sys.argv[1] == '1':
+    asyncio.run(run_lifespan())
+print(json.dumps(result))
+"""
+
+
+def import_time_report(top: int) -> None:
+    """python -X importtime 的结果, 按累计耗时和自身耗时排序"""
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=BASE_DIR, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:') :].split('|')
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+
+    total = next(cumulative for _, cumulative, name in rows if name.strip() == 'main')
+    print(f'import main: {total / 1000:.1f} ms\n')
+    print(f'top {top} by cumulative time (ms):')
+    for self_us, cumulative_us, name in sorted(rows, key=lambda row: row[1], reverse=True)[:top]:
+        print(f'{cumulative_us / 1000:10.1f} {name}')
+    print(f'\ntop {top} by self time (ms):')
+    for self_us, cumulative_us, name in sorted(rows, key=lambda row: row[0], reverse=True)[:top]:
+        print(f'{self_us / 1000:10.1f} {name.strip()}')
+
+
+def benchmark(rounds: int, lifespan: bool) -> None:
+    results = []
+    for _ in range(rounds):
+        completed = subprocess.run(
+            [sys.executable, '-c', BENCHMARK_CODE, '1' if lifespan else '0'], cwd=BASE_DIR, capture_output=True, text=True, check=True
+        )
+        results.append(json.loads(completed.stdout.splitlines()[-1]))
+
+    print(f'\ncold start over {rounds} fresh interpreters (ms):')
+    for phase in results[0]:
+        samples = [result[phase] * 1000 for result in results]
+        print(f'{phase:>10}: median {statistics.median(samples):.1f}  min {min(samples):.1f}  max {max(samples):.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=25, help='rows in the import time report')
+    parser.add_argument('--rounds', type=int, default=5, help='fresh interpreters in the benchmark')
+    parser.add_argument('--lifespan', action='store_true', help='also run the app startup events')
+    args = parser.parse_args()
+
+    import_time_report(args.top)
+    benchmark(args.rounds, args.lifespan)
+
+
+if __name__ == '__main__':
+    main()
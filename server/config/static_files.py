@@ -0,0 +1,131 @@
+"""
+/static 的静态文件服务:
+以内容哈希命名的文件 (上传的头像及其缩略图) 返回 Cache-Control: immutable, 浏览器一年内不再请求;
+其他文件要求每次用 ETag 协商, 未变化时返回 304;
+存在预压缩的 .br / .gz 文件时按 Accept-Encoding 返回压缩版本。
+
+预压缩文件用下面的命令生成:
+
+    python -m server.config.static_files server/statics
+"""
+
+import argparse
+import gzip
+import os
+import re
+import stat
+from mimetypes import guess_type
+from pathlib import Path
+
+import anyio.to_thread
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, PathLike, StaticFiles
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HASHED_NAME = re.compile(r'^[0-9a-f]{32}(_\d+)?\.[0-9a-z]+$')  # 内容哈希 (及缩略图边长) 命名的文件
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+PRECOMPRESSED_SUFFIXES = {'br': '.br', 'gzip': '.gz'}  # 按服务端偏好排序
+COMPRESSIBLE_SUFFIXES = {'.css', '.csv', '.html', '.js', '.json', '.map', '.svg', '.txt', '.xml'}
+
+
+def accepted_encodings(accept_encoding: str) -> list[str]:
+    """按服务端偏好返回客户端接受的预压缩编码"""
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, param = item.partition(';')
+        param = param.strip()
+        if param.startswith('q='):
+            try:
+                if float(param[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return [encoding for encoding in PRECOMPRESSED_SUFFIXES if encoding in accepted or '*' in accepted]
+
+
+class CachedStaticFiles(StaticFiles):
+    """在 StaticFiles 基础上加上长期缓存、强 ETag 和预压缩文件协商"""
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        stem, suffix = os.path.splitext(path)
+        if suffix.lower() in PRECOMPRESSED_SUFFIXES.values() and os.path.splitext(stem)[1].lower() in COMPRESSIBLE_SUFFIXES:
+            # 预压缩文件只通过 Accept-Encoding 协商返回, 直接请求时没有正确的 Content-Type / Content-Encoding
+            raise HTTPException(status_code=404)
+        if scope['method'] in ('GET', 'HEAD') and os.path.splitext(path)[1].lower() in COMPRESSIBLE_SUFFIXES:
+            for encoding in accepted_encodings(Headers(scope=scope).get('accept-encoding', '')):
+                full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path + PRECOMPRESSED_SUFFIXES[encoding])
+                if stat_result and stat.S_ISREG(stat_result.st_mode):
+                    return self.build_response(full_path, stat_result, scope, os.path.basename(path), encoding)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path: PathLike, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        return self.build_response(full_path, stat_result, scope, os.path.basename(full_path), status_code=status_code)
+
+    def build_response(
+        self,
+        full_path: PathLike,
+        stat_result: os.stat_result,
+        scope: Scope,
+        name: str,
+        encoding: str | None = None,
+        status_code: int = 200,
+    ) -> Response:
+        """name 是请求的文件名, 压缩版本按原文件名确定 Content-Type 和缓存策略"""
+        headers = {}
+        if HASHED_NAME.match(name):
+            headers['cache-control'] = IMMUTABLE_CACHE_CONTROL
+            # 文件名就是内容哈希, 直接作为强 ETag, 不同编码的表示各自不同
+            headers['etag'] = f'"{name}.{encoding}"' if encoding else f'"{name}"'
+        else:
+            headers['cache-control'] = REVALIDATE_CACHE_CONTROL
+        if os.path.splitext(name)[1].lower() in COMPRESSIBLE_SUFFIXES:
+            headers['vary'] = 'Accept-Encoding'
+        if encoding:
+            headers['content-encoding'] = encoding
+
+        response = FileResponse(
+            full_path,
+            status_code=status_code,
+            stat_result=stat_result,
+            media_type=guess_type(name)[0] or 'text/plain',
+            headers=headers,
+        )
+        if encoding and not HASHED_NAME.match(name):
+            response.headers['etag'] = f'{response.headers["etag"][:-1]}.{encoding}"'
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def precompress(directory: Path) -> None:
+    """为可压缩的静态文件生成 .gz (安装了 brotli 时还有 .br), 压缩后不更小的跳过"""
+    for path in directory.rglob('*'):
+        if not path.is_file() or path.suffix.lower() not in COMPRESSIBLE_SUFFIXES:
+            continue
+        data = path.read_bytes()
+        variants = {'.gz': lambda: gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = lambda: brotli.compress(data, quality=11)
+        for suffix, compress in variants.items():
+            target = path.with_name(path.name + suffix)
+            if target.exists() and target.stat().st_mtime >= path.stat().st_mtime:
+                continue
+            compressed = compress()
+            if len(compressed) < len(data):
+                target.write_bytes(compressed)
+                print(f'{target} {len(data)} -> {len(compressed)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='生成静态文件的预压缩版本')
+    parser.add_argument('directory', type=Path)
+    precompress(parser.parse_args().directory)
@@ -0,0 +1,33 @@
+"""
+gunicorn 生产环境的 worker 类与启动耗时统计, 配合 gunicorn_config.py 使用。
+"""
+
+import logging
+import os
+import time
+
+from uvicorn.workers import UvicornWorker
+
+# 传播到 gunicorn 自己的 errorlog 处理器; gunicorn.error 本身只把 ERROR 写入 error.log
+startup_logger = logging.getLogger('gunicorn.error.startup')
+startup_logger.setLevel(logging.INFO)
+
+# 由 gunicorn_config.post_fork 在子进程中设置, 不经过 gunicorn 运行时为 None
+worker_forked_at: float | None = None
+
+
+class UvloopUvicornWorker(UvicornWorker):
+    """明确使用 uvloop 和 httptools, 缺少依赖时启动即报错, 而不是悄悄退回纯 Python 实现"""
+
+    CONFIG_KWARGS = {'loop': 'uvloop', 'http': 'httptools', 'lifespan': 'on'}
+
+
+def mark_worker_forked() -> None:
+    global worker_forked_at
+    worker_forked_at = time.perf_counter()
+
+
+async def log_worker_ready() -> None:
+    """最后一个 startup 事件: 记录 worker 从 fork 到可以处理请求的耗时"""
+    if worker_forked_at is not None:
+        startup_logger.info(f'Worker {os.getpid()} ready in {time.perf_counter() - worker_forked_at:.3f} seconds after fork')
@@ -1,11 +1,16 @@
-import json
+import os
+from typing import Optional
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 
+from server.config.db_backend import get_pool_stats
 from server.module.common.accepts import CreatedResponse, SuccessResponse
+from server.module.common.constrants import MAX_PARAMETER_BATCH_SIZE
+from server.module.common.db_routing import read_only_request
 from server.module.common.exceptions import BadRequest
 from server.module.common.global_variable import DataResponse
 from server.module.common.models import DataTypeEnum, SystemParameter
+from server.module.common.parameter_cache import fetch_params, get_param, invalidate_param
 from server.module.common.pydantics import SystemParameterCreatePydantic, SystemParameterUpdatePydantic
 from server.module.user.models import User
 from server.module.user.utils import current_user
@@ -13,75 +18,55 @@ from server.module.user.utils import current_user
 router = APIRouter()
 
 
+def validate_param_data(data_type: DataTypeEnum, data: str) -> None:
+    """按读取时的 SystemParameter.get_data 解析一次, 覆盖所有数据类型, 无法解析时返回 400"""
+    try:
+        SystemParameter(data_type=data_type, data=data).get_data()
+    except (ValueError, TypeError):
+        raise BadRequest(f'{data} 解析为 {data_type.value} 类型失败, 请检查数据')
+
+
 @router.post('/parameter/')
 async def create_system_parameter(param: SystemParameterCreatePydantic, me: User = Depends(current_user)):
     is_param_exists = await SystemParameter.exists(name=param.name)
     if is_param_exists:
         raise BadRequest('参数已存在, 请勿重复创建')
-    try:
-        match param.data_type:
-            case DataTypeEnum.STRING:
-                pass
-            case DataTypeEnum.INTEGER:
-                int(param.data)
-            case DataTypeEnum.FLOAT:
-                float(param.data)
-            case DataTypeEnum.JSON:
-                json.loads(param.data)
-            case _:
-                raise Exception('')
-    except:
-        raise BadRequest(f'{param.data} 解析为 {param.data_type.value} 类型失败, 请检查数据')
+    validate_param_data(param.data_type, param.data)
     await SystemParameter.create(**param.model_dump())
+    await invalidate_param(param.name)  # 清除之前缓存的"不存在"
     return CreatedResponse()
 
 
 @router.put('/parameter/{param_name}/')
-async def update_system_parameter(param: SystemParameterUpdatePydantic, me: User = Depends(current_user)):
-    param_obj = await SystemParameter.get_or_none(name=param.name)
+async def update_system_parameter(param_name: str, param: SystemParameterUpdatePydantic, me: User = Depends(current_user)):
+    param_obj = await SystemParameter.get_or_none(name=param_name)
     if not param_obj:
         raise BadRequest('参数不存在, 请先创建')
-    try:
-        match param.data_type:
-            case DataTypeEnum.STRING:
-                pass
-            case DataTypeEnum.INTEGER:
-                int(param.data)
-            case DataTypeEnum.FLOAT:
-                float(param.data)
-            case DataTypeEnum.JSON:
-                json.loads(param.data)
-            case _:
-                raise Exception('')
-        if param.description:
-            param_obj.description = param.description
-        param_obj.data_type = param.data_type
-        param_obj.data = param.data
-    except:
-        raise BadRequest(f'{param.data} 解析为 {param.data_type.value} 类型失败, 请检查数据')
+    validate_param_data(param.data_type, param.data)
+    if param.description:
+        param_obj.description = param.description
+    param_obj.data_type = param.data_type
+    param_obj.data = param.data
     await param_obj.save()
+    await invalidate_param(param_name)
     return SuccessResponse()
 
 
-@router.get('/parameter/{param_name}/')
+@router.get('/parameter/', dependencies=[Depends(read_only_request)])
+async def get_system_parameters(
+    names: Optional[list[str]] = Query(None, max_length=MAX_PARAMETER_BATCH_SIZE),
+    prefix: Optional[str] = Query(None, min_length=1),
+    me: User = Depends(current_user),
+):
+    """按名称列表和/或名称前缀批量获取参数, 返回 {name: value}"""
+    if not names and not prefix:
+        raise BadRequest('请指定参数名称或前缀')
+    return DataResponse(data=await fetch_params(names, prefix))
+
+
+@router.get('/parameter/{param_name}/', dependencies=[Depends(read_only_request)])
 async def get_system_parameter(param_name: str, me: User = Depends(current_user)):
-    data = await SystemParameter.get_or_none(name=param_name)
-    response = None
-    if data:
-        try:
-            match data.data_type:
-                case DataTypeEnum.STRING:
-                    response = data.data
-                case DataTypeEnum.INTEGER:
-                    response = int(data.data)
-                case DataTypeEnum.FLOAT:
-                    response = float(data.data)
-                case DataTypeEnum.JSON:
-                    response = json.loads(data.data)
-                case _:
-                    response = None
-        except:
-            response = None
+    response = await get_param(param_name)
     return DataResponse(data=response)
 
 
@@ -91,4 +76,11 @@ async def delete_system_parameter(param_name: str, me: User = Depends(current_us
     if not param_obj:
         raise BadRequest('参数不存在, 无需删除')
     await param_obj.delete()
+    await invalidate_param(param_name)
     return SuccessResponse()
+
+
+@router.get('/db-pool/')
+async def get_db_pool_stats(me: User = Depends(current_user)):
+    """处理本次请求的 worker 进程的数据库连接池统计"""
+    return DataResponse(data={'pid': os.getpid(), 'pools': get_pool_stats()})
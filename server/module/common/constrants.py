@@ -1,12 +1,13 @@
-from server.config.settings import BASE_DIR
+from server.config.settings import STATIC_PATH
 
 DEFALT_PASSWORD = 'ffffuck'
 DEBUG_PASSWORD = '49b4e29241ed58d8b6bc1d84bf7c8593'
 
-STATIC_STATIC_PATH = BASE_DIR / 'statics'
+STATIC_STATIC_PATH = STATIC_PATH
 AVATAR_STATIC_PATH = STATIC_STATIC_PATH / 'avatar'
 EXPORT_STATIC_PARH = STATIC_STATIC_PATH / 'export'
 UPLOAD_STATIC_PARH = STATIC_STATIC_PATH / 'upload'
+AVATAR_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
 
 
 SEPARATOR = '&' * 8
@@ -15,3 +16,6 @@ LAZY_LOAD_SIZE = 10  # table lazy load default size
 
 # temp remove lazy load
 FIRST_LOAD_SIZE = 99  # table without pagination first default size
+MAX_PAGE_SIZE = 500  # upper bound of a page size requested by the client
+
+MAX_PARAMETER_BATCH_SIZE = 100  # max names per bulk parameter request
@@ -0,0 +1,66 @@
+"""
+只读副本路由: config.yaml 中配置了 database.replica 时, 只读接口的查询走 replica 连接。
+
+接口通过依赖 read_only_request 声明自己只读, 其中经 read_db 取连接的查询才会走副本;
+其他接口 (包括在写接口中调用的同一批读取函数) 一律走主库, 不会读到旧数据再写回。
+
+主从复制有延迟, 写入后调用 mark_written 标记作用域 (订单缓存键 / 用户 / 参数),
+REPLICA_STICKY_SECONDS 秒内同一作用域的读取仍走主库, 保证写入方马上能读到自己的写入。
+"""
+
+from contextvars import ContextVar
+
+from tortoise import connections
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from server.config.settings import REPLICA_ENABLED, REPLICA_STICKY_SECONDS
+from server.module.common.lru_cache import LRUCache
+from server.module.common.redis_client import cache_client
+
+PRIMARY_CONNECTION = 'default'
+REPLICA_CONNECTION = 'replica'
+# 本进程刚写过的作用域, 不必查 Redis 就能确定走主库
+_local_written = LRUCache(maxsize=4096, ttl=REPLICA_STICKY_SECONDS)
+_read_only: ContextVar[bool] = ContextVar('read_only', default=False)
+
+
+def _written_key(scope: str) -> str:
+    return f'db.written.{scope}'
+
+
+def user_scope(user_id: int | str) -> str:
+    return f'user.{user_id}'
+
+
+async def read_only_request() -> None:
+    """路由依赖: 声明接口只读, 每个请求在独立的上下文中执行, 不需要复位"""
+    _read_only.set(True)
+
+
+async def mark_written(*scopes: str) -> None:
+    """写入后调用, 标记的作用域在 REPLICA_STICKY_SECONDS 秒内读主库; 没有配置副本时不做任何事"""
+    if not REPLICA_ENABLED or not scopes:
+        return
+    for scope in scopes:
+        _local_written.set(scope, True)
+    async with cache_client.pipeline(transaction=False) as pipe:
+        for scope in scopes:
+            pipe.set(cache_client.key(_written_key(scope)), 1, ex=REPLICA_STICKY_SECONDS)
+
+
+async def _recently_written(scopes: tuple[str, ...]) -> bool:
+    if any(_local_written.get(scope) for scope in scopes):
+        return True
+    redis = await cache_client.get_redis()
+    # 其他 worker 的写入
+    return await redis.exists(*(cache_client.key(_written_key(scope)) for scope in scopes)) > 0
+
+
+async def read_db(*scopes: str) -> BaseDBAsyncClient:
+    """
+    返回本次读取应使用的连接: 只读请求、配置了副本且 scopes 近期没有写入时为副本, 否则为主库。
+    scopes 为空时只看是否只读请求。
+    """
+    if REPLICA_ENABLED and _read_only.get() and not (scopes and await _recently_written(scopes)):
+        return connections.get(REPLICA_CONNECTION)
+    return connections.get(PRIMARY_CONNECTION)
@@ -1,9 +1,18 @@
 # email_service.py
+import json
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
 from typing import List
 
 # 从 settings.py 导入配置
 from server.config import settings
+from server.module.common.redis_client import cache_client
+from server.module.common.utils import get_uuid4_id
+
+# 发件箱队列, 由 email_worker 消费
+MAIL_OUTBOX_KEY = f'{settings.CACHE_HEADER}mail.outbox'
+MAIL_PROCESSING_KEY = f'{settings.CACHE_HEADER}mail.processing'  # 已取出但尚未确认发送的邮件
+MAIL_RETRY_KEY = f'{settings.CACHE_HEADER}mail.retry'  # zset, score 为下次重试时间
+MAIL_DEAD_KEY = f'{settings.CACHE_HEADER}mail.dead'  # 超过重试次数的邮件
 
 # 创建一个 ConnectionConfig 对象
 conf = ConnectionConfig(
@@ -39,3 +48,17 @@ async def send_email(email: List[str], subject: str, body: str):
     except Exception as e:
         print(f"邮件发送失败: {e}")
         return False
+
+
+async def enqueue_email(email: str, subject: str, body: str):
+    """
+    把邮件放入 Redis 发件箱后立即返回, 由 email_worker 使用 SMTP 长连接批量发送。
+
+    Args:
+        email (str): 收件人邮箱。
+        subject (str): 邮件主题。
+        body (str): 邮件内容 (HTML)。
+    """
+    message = {'id': get_uuid4_id(), 'recipients': [email], 'subject': subject, 'body': body, 'attempts': 0}
+    client = await cache_client.get_redis()
+    await client.lpush(MAIL_OUTBOX_KEY, json.dumps(message))
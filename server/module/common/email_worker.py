@@ -0,0 +1,214 @@
+"""
+发件箱消费进程, 与 gunicorn 分开运行, 同一时间只运行一个:
+
+    python -m server.module.common.email_worker
+"""
+
+import asyncio
+import json
+import os
+import signal
+import time
+from email.message import EmailMessage
+from email.utils import formataddr
+from pathlib import Path
+
+import aiosmtplib
+from redis.exceptions import RedisError
+
+from server.config import settings
+from server.config.request_metrics import EMAIL_WORKER_METRICS_SUBDIR, prepare_metrics_dir
+
+# SMTP 指标写到 gunicorn 指标目录下的子目录, 由 /metrics 一并汇总; 必须在导入 prometheus_client 之前设置
+METRICS_DIR = Path(settings.METRICS_DIR) / EMAIL_WORKER_METRICS_SUBDIR
+os.environ['PROMETHEUS_MULTIPROC_DIR'] = str(METRICS_DIR)
+
+from prometheus_client import Histogram  # noqa: E402
+
+from server.module.common.email_utils import MAIL_DEAD_KEY, MAIL_OUTBOX_KEY, MAIL_PROCESSING_KEY, MAIL_RETRY_KEY  # noqa: E402
+from server.module.common.redis_client import cache_client  # noqa: E402
+
+RETRY_BASE_DELAY = 5  # 秒, 第 n 次失败后等待 RETRY_BASE_DELAY * 2 ** (n - 1)
+RETRY_MAX_DELAY = 30 * 60
+ERROR_BACKOFF = 5  # 秒, Redis 出错或循环中出现意外错误后等待这么久再继续
+MESSAGE_FIELDS = ('recipients', 'subject', 'body', 'attempts')  # enqueue_email 写入的字段
+
+SMTP_SEND_LATENCY = Histogram(
+    'smtp_send_duration_seconds',
+    'SMTP send latency per message, including reconnects',
+    ['result'],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+
+
+class EmailOutboxWorker:
+    """从 Redis 发件箱取邮件, 复用同一个 SMTP 连接批量发送, 失败按指数退避重试"""
+
+    def __init__(self) -> None:
+        self.redis = None
+        self.smtp: aiosmtplib.SMTP | None = None
+        self.last_used = 0.0
+        self.stopped = False
+
+    def stop(self, *_):
+        self.stopped = True
+
+    async def run(self):
+        recovered = False
+        while not self.stopped:
+            try:
+                if not recovered:
+                    self.redis = await cache_client.get_redis()
+                    await self.recover_processing()
+                    recovered = True
+                await self.run_once()
+            except RedisError as e:
+                # 中断的批次留在处理中列表, 恢复连接后放回发件箱
+                print(f"Redis 出错, {ERROR_BACKOFF} 秒后重试: {e!r}")
+                recovered = False
+                await asyncio.sleep(ERROR_BACKOFF)
+            except Exception as e:
+                print(f"发件箱循环出错, {ERROR_BACKOFF} 秒后重试: {e!r}")
+                await asyncio.sleep(ERROR_BACKOFF)
+        await self.disconnect()
+
+    async def run_once(self):
+        await self.promote_due_retries()
+        batch = await self.pop_batch()
+        if batch:
+            await self.deliver(batch)
+        elif self.smtp and time.monotonic() - self.last_used > settings.MAIL_IDLE_TIMEOUT:
+            await self.disconnect()
+
+    async def recover_processing(self):
+        """上次进程退出时未确认的邮件重新放回发件箱"""
+        while await self.redis.lmove(MAIL_PROCESSING_KEY, MAIL_OUTBOX_KEY, 'RIGHT', 'RIGHT'):
+            pass
+
+    async def promote_due_retries(self):
+        due = await self.redis.zrangebyscore(MAIL_RETRY_KEY, '-inf', time.time())
+        for raw in due:
+            if await self.redis.zrem(MAIL_RETRY_KEY, raw):
+                await self.redis.lpush(MAIL_OUTBOX_KEY, raw)
+
+    async def pop_batch(self) -> list[str]:
+        raw = await self.redis.blmove(MAIL_OUTBOX_KEY, MAIL_PROCESSING_KEY, 1, 'RIGHT', 'LEFT')
+        if not raw:
+            return []
+        batch = [raw]
+        while len(batch) < settings.MAIL_OUTBOX_BATCH_SIZE:
+            raw = await self.redis.lmove(MAIL_OUTBOX_KEY, MAIL_PROCESSING_KEY, 'RIGHT', 'LEFT')
+            if not raw:
+                break
+            batch.append(raw)
+        return batch
+
+    async def connect(self):
+        if self.smtp and self.smtp.is_connected:
+            return
+        self.smtp = aiosmtplib.SMTP(
+            hostname=settings.MAIL_SERVER,
+            port=settings.MAIL_PORT,
+            use_tls=settings.MAIL_SSL_TLS,
+            start_tls=settings.MAIL_STARTTLS,
+        )
+        await self.smtp.connect()
+        await self.smtp.login(settings.MAIL_FROM, settings.MAIL_SECRET)
+
+    async def disconnect(self):
+        if self.smtp and self.smtp.is_connected:
+            try:
+                await self.smtp.quit()
+            except aiosmtplib.SMTPException:
+                self.smtp.close()
+        self.smtp = None
+
+    def build_message(self, message: dict) -> EmailMessage:
+        email = EmailMessage()
+        email['From'] = formataddr((settings.MAIL_FROMNAME, settings.MAIL_FROM))
+        email['To'] = ', '.join(message['recipients'])
+        email['Subject'] = message['subject']
+        email.set_content(message['body'], subtype='html')
+        return email
+
+    async def send(self, message: dict):
+        """发送一封邮件, 连接被服务器断开时重连一次"""
+        for reconnect in (False, True):
+            try:
+                await self.connect()
+                await self.smtp.send_message(self.build_message(message))
+                self.last_used = time.monotonic()
+                return
+            except aiosmtplib.SMTPServerDisconnected:
+                self.smtp = None
+                if reconnect:
+                    raise
+
+    @staticmethod
+    def parse_message(raw: str) -> dict | None:
+        """发件箱中的一条邮件, 无法解析或缺少字段时返回 None"""
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            return None
+        if not isinstance(message, dict) or not all(field in message for field in MESSAGE_FIELDS):
+            return None
+        return message
+
+    async def dead_letter(self, raw: str):
+        await self.redis.lpush(MAIL_DEAD_KEY, raw)
+        await self.redis.lrem(MAIL_PROCESSING_KEY, 1, raw)
+
+    def reset_connection(self):
+        if self.smtp:
+            self.smtp.close()
+        self.smtp = None
+
+    async def deliver(self, batch: list[str]):
+        for raw in batch:
+            message = self.parse_message(raw)
+            if message is None:
+                # 格式错误的邮件不重试, 直接移入死信列表, 不影响后续邮件
+                print(f"邮件格式错误, 已移入死信列表: {raw[:200]!r}")
+                await self.dead_letter(raw)
+                continue
+            start_time = time.perf_counter()
+            try:
+                await self.send(message)
+                SMTP_SEND_LATENCY.labels('ok').observe(time.perf_counter() - start_time)
+                print(f"邮件已成功发送至: {message['recipients']}")
+            except (aiosmtplib.SMTPException, OSError) as e:
+                SMTP_SEND_LATENCY.labels('error').observe(time.perf_counter() - start_time)
+                await self.schedule_retry(message, e)
+            except Exception as e:
+                # 构建或发送时的意外错误 (字段类型不对等) 重试也不会成功, 移入死信列表, 连接状态未知, 断开重连
+                SMTP_SEND_LATENCY.labels('error').observe(time.perf_counter() - start_time)
+                print(f"邮件发送出错, 已移入死信列表: {message['recipients']} {e!r}")
+                self.reset_connection()
+                await self.dead_letter(raw)
+                continue
+            await self.redis.lrem(MAIL_PROCESSING_KEY, 1, raw)
+
+    async def schedule_retry(self, message: dict, error: Exception):
+        message['attempts'] += 1
+        if message['attempts'] >= settings.MAIL_MAX_RETRIES:
+            print(f"邮件发送失败, 已放弃: {message['recipients']} {error}")
+            await self.redis.lpush(MAIL_DEAD_KEY, json.dumps(message))
+            return
+        delay = min(RETRY_BASE_DELAY * 2 ** (message['attempts'] - 1), RETRY_MAX_DELAY)
+        print(f"邮件发送失败, {delay} 秒后重试: {message['recipients']} {error}")
+        await self.redis.zadd(MAIL_RETRY_KEY, {json.dumps(message): time.time() + delay})
+
+
+async def main():
+    # 同一时间只运行一个发件箱进程, 启动时清掉上一个进程留下的指标文件
+    prepare_metrics_dir(METRICS_DIR)
+    worker = EmailOutboxWorker()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    await worker.run()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+上传文件落盘与图片缩略图。
+上传按块读取, 写文件放到线程中执行; 缩略图在进程池中生成, 不占用事件循环和 worker 的 GIL。
+"""
+
+import asyncio
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from uuid import uuid4
+
+from fastapi import UploadFile
+
+from server.config.settings import THUMBNAIL_WORKERS
+from server.module.common.exceptions import BadRequest
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+THUMBNAIL_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}  # 扩展名: Pillow 格式
+THUMBNAIL_QUALITY = 80
+MAX_IMAGE_PIXELS = 50_000_000  # 超过该像素数 Pillow 拒绝解码, 防止解压炸弹
+_thumbnail_executor: ProcessPoolExecutor | None = None
+_thumbnail_executor_pid = None
+
+
+def _write_chunk(f, digest, chunk: bytes) -> None:
+    digest.update(chunk)
+    f.write(chunk)
+
+
+def _discard(f, path: Path) -> None:
+    f.close()
+    path.unlink(missing_ok=True)
+
+
+async def save_upload(file: UploadFile, directory: Path, suffix: str, max_size: int) -> str:
+    """
+    分块写入 directory, 超过 max_size 字节时删除已写入的部分并报错。
+    文件以内容哈希命名, 内容不变文件名就不变, /static 可以让浏览器永久缓存; 返回文件名。
+    """
+    if file.size is not None and file.size > max_size:
+        raise BadRequest(f'文件不能超过 {max_size // 1024 // 1024} MB')
+
+    # 先写临时文件, 写完再改名, 静态文件服务不会读到写了一半的文件
+    part_path = directory / f'{uuid4().hex}.part'
+    digest = hashlib.sha256()
+    f = await asyncio.to_thread(open, part_path, 'wb')
+    size = 0
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise BadRequest(f'文件不能超过 {max_size // 1024 // 1024} MB')
+            await asyncio.to_thread(_write_chunk, f, digest, chunk)
+    except BaseException:
+        await asyncio.to_thread(_discard, f, part_path)
+        raise
+    await asyncio.to_thread(f.close)
+    filename = digest.hexdigest()[:32] + suffix
+    await asyncio.to_thread(os.replace, part_path, directory / filename)
+    return filename
+
+
+def _make_thumbnails(source: str, sizes: list[int]) -> dict[int, dict[str, str]]:
+    """在子进程中执行: 生成正方形缩略图, 与原图放在同一目录, 返回 {边长: {扩展名: 文件名}}"""
+    # Pillow 只在缩略图子进程中导入, 不拖慢 worker 启动
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    source = Path(source)
+    try:
+        with Image.open(source) as image:
+            # JPEG 解码时直接按缩小的比例解码, 大图省掉大部分解码时间
+            image.draft('RGB', (max(sizes), max(sizes)))
+            image = ImageOps.exif_transpose(image).convert('RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        # 解码失败转为内置异常传回 worker, worker 不需要导入 Pillow 就能反序列化
+        raise ValueError(f'{type(e).__name__}: {e}') from None
+
+    thumbnails = {}
+    for size in sizes:
+        thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        thumbnails[size] = {}
+        for ext, image_format in THUMBNAIL_FORMATS.items():
+            name = f'{source.stem}_{size}.{ext}'
+            thumbnail.save(source.with_name(name), image_format, quality=THUMBNAIL_QUALITY)
+            thumbnails[size][ext] = name
+    return thumbnails
+
+
+def _get_thumbnail_executor() -> ProcessPoolExecutor:
+    global _thumbnail_executor, _thumbnail_executor_pid
+    if _thumbnail_executor is None or _thumbnail_executor_pid != os.getpid():
+        # worker 进程里已有日志/密码哈希等线程, 用 spawn 而不是 fork 创建子进程
+        _thumbnail_executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        _thumbnail_executor_pid = os.getpid()
+    return _thumbnail_executor
+
+
+async def generate_thumbnails(source: Path, sizes: list[int]) -> dict[int, dict[str, str]]:
+    """在进程池中生成缩略图, 文件不是可识别的图片时报错"""
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_thumbnail_executor(), _make_thumbnails, str(source), sizes)
+    except ValueError:
+        raise BadRequest('无法识别的图片文件')
+
+
+async def shutdown_thumbnail_executor() -> None:
+    global _thumbnail_executor
+    if _thumbnail_executor is not None and _thumbnail_executor_pid == os.getpid():
+        _thumbnail_executor.shutdown(wait=False, cancel_futures=True)
+    _thumbnail_executor = None
@@ -1,11 +1,19 @@
+import atexit
+import gzip
 import json
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import os
+import queue
+import shutil
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 from typing import Any
 
 from fastapi import Response, status
 from fastapi.security.oauth2 import OAuth2PasswordBearer
 
+from server.config.settings import LOG_COMPRESS, LOG_JSON, LOG_QUEUE_SIZE
+from server.module.common.utils import json_dumps
+
 # 配置日志级别
 loglevel = 'info'
 
@@ -19,56 +27,146 @@ error_log_filename = './logs/error.log'
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/user/token/")
 
-# 配置按天分割日志文件，并在文件名中加入日期
-access_handler = TimedRotatingFileHandler(
-    access_log_filename,
-    when='D',
-    interval=1,
-    backupCount=30,
-    encoding='utf-8',
-    utc=False,
-)
-error_handler = TimedRotatingFileHandler(
-    error_log_filename,
-    when='D',
-    interval=1,
-    backupCount=30,
-    encoding='utf-8',
-    utc=False,
-)
-
-# 设置日志格式
-formatter = logging.Formatter(log_format)
-access_handler.setFormatter(formatter)
-error_handler.setFormatter(formatter)
-
-# 设置日志级别
-access_handler.setLevel(logging.INFO)
-error_handler.setLevel(logging.ERROR)
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'name': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class DropCountingQueueHandler(QueueHandler):
+    """日志只放入有界队列, 队列满时丢弃而不是阻塞事件循环, 并记录丢弃数量"""
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._reported = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped != self._reported:
+            dropped, self._reported = self.dropped - self._reported, self.dropped
+            warning = logging.makeLogRecord(
+                {'name': 'gunicorn.error', 'levelno': logging.ERROR, 'levelname': 'ERROR', 'msg': f'日志队列已满, 丢弃了 {dropped} 条日志'}
+            )
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                pass
+
+
+def gzip_rotator(source: str, dest: str) -> None:
+    """在监听线程里压缩轮转出来的日志文件"""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def create_file_handler(filename: str, level: int, logger_name: str) -> TimedRotatingFileHandler:
+    # 配置按天分割日志文件，并在文件名中加入日期
+    handler = TimedRotatingFileHandler(
+        filename,
+        when='D',
+        interval=1,
+        backupCount=30,
+        encoding='utf-8',
+        utc=False,
+        delay=True,
+    )
+    # 设置日志格式
+    handler.setFormatter(JsonFormatter() if LOG_JSON else logging.Formatter(log_format))
+    # 设置日志级别
+    handler.setLevel(level)
+    # 两个日志共用一个队列, 按记录器名称分发到各自的文件
+    handler.addFilter(logging.Filter(logger_name))
+    if LOG_COMPRESS:
+        handler.namer = lambda name: name + '.gz'
+        handler.rotator = gzip_rotator
+    return handler
+
+
+access_handler = create_file_handler(access_log_filename, logging.INFO, 'gunicorn.access')
+error_handler = create_file_handler(error_log_filename, logging.ERROR, 'gunicorn.error')
+
+# 请求处理中只做入队, 文件写入和轮转都在每个进程唯一的监听线程中完成
+log_queue_handler = DropCountingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+_log_listener: QueueListener | None = None
+
+
+def start_log_listener() -> None:
+    """启动当前进程的日志监听线程: 应用的 startup 事件中调用, gunicorn master 在 when_ready 中调用 (此时已经 daemonize)"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    _log_listener = QueueListener(log_queue_handler.queue, access_handler, error_handler, respect_handler_level=True)
+    _log_listener.start()
+
+
+def stop_log_listener() -> None:
+    """写完队列中剩余的日志后停止监听线程"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def _reset_log_queue_after_fork() -> None:
+    # fork 出的子进程没有父进程的监听线程, 队列锁也可能处于被持有的状态, 换一个新的队列
+    global _log_listener
+    log_queue_handler.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _log_listener = None
+
+
+os.register_at_fork(after_in_child=_reset_log_queue_after_fork)
+atexit.register(stop_log_listener)
 
 # 配置日志记录器
 access_logger = logging.getLogger('gunicorn.access')
-access_logger.addHandler(access_handler)
+access_logger.addHandler(log_queue_handler)
 access_logger.setLevel(logging.INFO)
 
 error_logger = logging.getLogger('gunicorn.error')
-error_logger.addHandler(error_handler)
+error_logger.addHandler(log_queue_handler)
 error_logger.setLevel(logging.ERROR)
 
 
-class DataResponse(object):
+class FastJSONResponse(Response):
+    """Serialize once with orjson, used as the app's default response class"""
+
+    media_type = 'application/json'
+
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+
+class DataResponse(FastJSONResponse):
     """Retrun default code 200 and data"""
 
     def __init__(
         self,
         message: str = 'success',
         data: Any = None,
+        headers: dict[str, str] | None = None,
     ) -> None:
         self.message = message
         self.data = data
+        super().__init__({'message': message, 'data': data}, headers=headers)
 
 
-class BaseResponse(Response):
+class BaseResponse(FastJSONResponse):
     """Return with status code and response message, but no data"""
 
     def __init__(
@@ -82,4 +180,4 @@ class BaseResponse(Response):
         content = {'message': message}
         if data:
             content['data'] = data
-        super().__init__(status_code=code, content=json.dumps(content))
+        super().__init__(content, status_code=code)
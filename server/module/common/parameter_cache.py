@@ -0,0 +1,188 @@
+"""
+系统参数缓存: 进程内 -> Redis -> 数据库。
+参数增删改后调用 invalidate_param, 通过 Redis 发布订阅通知所有 worker 清除进程内缓存。
+只读请求中回源数据库时读副本, 参数写入后的一小段时间内仍读主库。
+"""
+
+import asyncio
+import json
+from datetime import timedelta
+from typing import Any
+
+from server.module.common.db_routing import mark_written, read_db
+from server.module.common.lru_cache import LRUCache
+from server.module.common.models import DataTypeEnum, SystemParameter
+from server.module.common.redis_client import cache_client
+from server.module.common.utils import escape_like
+
+PARAM_CACHE_EXPIRE = timedelta(minutes=10)  # Redis 中参数缓存的有效期, 也是并发回填旧值时的最长陈旧时间
+PARAM_MISSING_EXPIRE = timedelta(minutes=1)  # 不存在的参数也缓存, 避免反复查库
+PARAM_INVALIDATE_CHANNEL = 'param.invalidate'
+PARAM_INVALIDATE_ALL = '*'
+PARAM_SCAN_BATCH_SIZE = 500  # 清除所有参数缓存时每批 SCAN / DELETE 的键数
+PARAM_WRITE_SCOPE = 'param'  # 参数很少写入, 不区分参数名, 任一参数写入后所有参数读取短时间内走主库
+# 失效靠发布订阅推送, 进程内 TTL 只是订阅断开期间漏掉消息时的兜底
+_local_param_cache = LRUCache(maxsize=1024, ttl=5 * 60)
+_MISSING = object()  # 参数不存在或无法解析
+_NOT_CACHED = object()
+_listener_task: asyncio.Task | None = None
+
+
+def _param_key(name: str) -> str:
+    return f'param.{name}'
+
+
+def _parse(data_type: str, data: str | None) -> Any:
+    """按 SystemParameter.get_data 解析, 数据无法解析时视为不存在"""
+    try:
+        return SystemParameter(data_type=DataTypeEnum(data_type), data=data).get_data()
+    except (ValueError, TypeError):
+        return _MISSING
+
+
+def _raw_param(row) -> dict:
+    """写入 Redis 的参数数据, row 为数据库查询结果的一行"""
+    return {'data_type': row['data_type'], 'data': row['data']}
+
+
+async def _load_params(names: list[str]) -> list[Any]:
+    """Redis (一次 MGET) -> 数据库 (一次查询), 按顺序返回解析后的值或 _MISSING, 从数据库读到的结果写回 Redis"""
+    redis = await cache_client.get_redis()
+    cached = await redis.mget([cache_client.key(_param_key(name)) for name in names])
+    values = {}
+    db_names = []
+    for name, raw in zip(names, cached):
+        if raw:
+            raw = json.loads(raw)
+            values[name] = _MISSING if raw is None else _parse(raw['data_type'], raw['data'])
+        else:
+            db_names.append(name)
+
+    if db_names:
+        db = await read_db(PARAM_WRITE_SCOPE)
+        rows = {row['name']: row for row in await db.execute_query_dict(FETCH_PARAMS_SQL, [db_names, None])}
+        async with cache_client.pipeline(transaction=False) as pipe:
+            for name in db_names:
+                row = rows.get(name)
+                if row:
+                    pipe.set(cache_client.key(_param_key(name)), json.dumps(_raw_param(row)), ex=PARAM_CACHE_EXPIRE)
+                    values[name] = _parse(row['data_type'], row['data'])
+                else:
+                    pipe.set(cache_client.key(_param_key(name)), 'null', ex=PARAM_MISSING_EXPIRE)
+                    values[name] = _MISSING
+    return [values[name] for name in names]
+
+
+async def get_param(name: str, default: Any = None) -> Any:
+    """
+    读取解析后的系统参数, 参数不存在或无法解析时返回 default。
+    返回的 json 参数是共享对象, 调用方不要修改。
+    """
+    value = _local_param_cache.get(name, _NOT_CACHED)
+    if value is _NOT_CACHED:
+        (value,) = await _load_params([name])
+        _local_param_cache.set(name, value)
+    return default if value is _MISSING else value
+
+
+FETCH_PARAMS_SQL = """
+SELECT "name", "data_type", "data" FROM "tb_system_parameter"
+WHERE "name" = ANY($1::varchar[]) OR "name" LIKE $2 ESCAPE '\\'
+"""
+
+
+async def _get_params(names: list[str]) -> dict[str, Any]:
+    """按名称批量读取, 与 get_param 走同一套缓存, 未命中的参数合并为一次 Redis 往返和一次查询"""
+    values = {}
+    missing = []
+    for name in dict.fromkeys(names):
+        value = _local_param_cache.get(name, _NOT_CACHED)
+        if value is _NOT_CACHED:
+            missing.append(name)
+        else:
+            values[name] = value
+    if missing:
+        for name, value in zip(missing, await _load_params(missing)):
+            _local_param_cache.set(name, value)
+            values[name] = value
+    return values
+
+
+async def _fetch_params_by_prefix(prefix: str) -> dict[str, Any]:
+    """前缀匹配无法从缓存得知有哪些参数, 查询数据库 (依赖 name 上的 varchar_pattern_ops 索引), 结果顺带写入各参数的缓存"""
+    db = await read_db(PARAM_WRITE_SCOPE)
+    rows = await db.execute_query_dict(FETCH_PARAMS_SQL, [[], f'{escape_like(prefix)}%'])
+    values = {}
+    async with cache_client.pipeline(transaction=False) as pipe:
+        for row in rows:
+            values[row['name']] = _parse(row['data_type'], row['data'])
+            _local_param_cache.set(row['name'], values[row['name']])
+            pipe.set(cache_client.key(_param_key(row['name'])), json.dumps(_raw_param(row)), ex=PARAM_CACHE_EXPIRE)
+    return values
+
+
+async def fetch_params(names: list[str] | None = None, prefix: str | None = None) -> dict[str, Any]:
+    """
+    批量取出参数: 按名称列表 和/或 名称前缀, 返回按名称排序的 {name: 解析后的值}。
+    与 get_param 一样, 不存在或无法解析的参数不在结果中。
+    """
+    values = {}
+    if names:
+        values.update(await _get_params(names))
+    if prefix:
+        values.update(await _fetch_params_by_prefix(prefix))
+    return {name: values[name] for name in sorted(values) if values[name] is not _MISSING}
+
+
+async def invalidate_param(name: str = PARAM_INVALIDATE_ALL) -> None:
+    """参数写入/删除后调用, 清除 Redis 缓存并通知所有 worker; 不指定参数名时清除所有参数的缓存"""
+    redis = await cache_client.get_redis()
+    if name == PARAM_INVALIDATE_ALL:
+        _local_param_cache.clear()
+        # SCAN 不阻塞 Redis, 参数缓存键按批删除
+        keys = [key async for key in redis.scan_iter(match=cache_client.key(_param_key('*')), count=PARAM_SCAN_BATCH_SIZE)]
+        for start in range(0, len(keys), PARAM_SCAN_BATCH_SIZE):
+            await redis.delete(*keys[start : start + PARAM_SCAN_BATCH_SIZE])
+    else:
+        _local_param_cache.pop(name)
+        await cache_client.del_cache(_param_key(name))
+    await mark_written(PARAM_WRITE_SCOPE)
+    await redis.publish(cache_client.key(PARAM_INVALIDATE_CHANNEL), name)
+
+
+async def _param_invalidation_listener() -> None:
+    while True:
+        try:
+            redis = await cache_client.get_redis()
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(cache_client.key(PARAM_INVALIDATE_CHANNEL))
+                # 订阅建立前可能漏掉了消息
+                _local_param_cache.clear()
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if not message:
+                        continue
+                    if message['data'] == PARAM_INVALIDATE_ALL:
+                        _local_param_cache.clear()
+                    else:
+                        _local_param_cache.pop(message['data'])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            from traceback import print_exc
+
+            print_exc()
+            await asyncio.sleep(1)
+
+
+async def start_param_invalidation_listener() -> None:
+    global _listener_task
+    if _listener_task is None:
+        _listener_task = asyncio.create_task(_param_invalidation_listener())
+
+
+async def stop_param_invalidation_listener() -> None:
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        _listener_task = None
@@ -3,25 +3,32 @@ from enum import Enum
 from typing import Optional
 
 from pydantic import BaseModel
-from tortoise.contrib.pydantic import pydantic_model_creator
 
 from server.module.common.models import DataTypeEnum
 
 
+class RateLimitMode(Enum):
+    FIXED_WINDOW = 'fixed'  # window starts at the first attempt and is not extended by later ones
+    SLIDING_WINDOW = 'sliding'  # at most `limit` attempts in any `expire` long window
+    TOKEN_BUCKET = 'token_bucket'  # bucket of `limit` tokens, refilled evenly over `expire`
+
+
 class _OptionType:
     code: int
     limit: int  # limit times
     expire: timedelta  # seconds
+    mode: RateLimitMode
 
-    def __init__(self, code, limit, expire) -> None:
+    def __init__(self, code, limit, expire, mode=RateLimitMode.FIXED_WINDOW) -> None:
         super().__init__()
         self.code = code
         self.limit = limit
         self.expire = timedelta(seconds=expire)
+        self.mode = mode
 
 
 class UserOperation(Enum):
-    TRY_PASSWORD: _OptionType = _OptionType(1, 3, 5 * 60)
+    TRY_PASSWORD: _OptionType = _OptionType(1, 3, 5 * 60, RateLimitMode.SLIDING_WINDOW)
     EDIT_INFO: _OptionType = _OptionType(2, 1, 30 * 60)
     EDIT_PASSWORD: _OptionType = _OptionType(3, 1, 60 * 60 * 24)
     EDIT_AVATAR: _OptionType = _OptionType(4, 1, 30 * 60)
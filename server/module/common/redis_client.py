@@ -1,10 +1,99 @@
 import json
+import os
+from contextlib import asynccontextmanager
 from datetime import timedelta
+from typing import NamedTuple
 
 from redis import asyncio
-
-from server.config.settings import CACHE_HEADER, REDIS_URL
+from redis.asyncio.client import Pipeline
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError, TimeoutError
+
+from server.config.settings import (
+    CACHE_HEADER,
+    REDIS_HEALTH_CHECK_INTERVAL,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_SOCKET_TIMEOUT,
+    REDIS_URL,
+)
+from server.config.request_metrics import record_redis_round_trip
 from server.module.common.pydantics import UserOperation
+from server.module.common.utils import get_uuid4_id
+
+# KEYS[1]: limit key; ARGV: mode, limit, window in ms, unique member for the sliding window log
+# returns {allowed (1/0), remaining, ms until the quota resets}
+RATE_LIMIT_LUA = """
+local mode = ARGV[1]
+local limit = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+if mode == 'fixed' then
+    local count = redis.call('INCR', KEYS[1])
+    local ttl = redis.call('PTTL', KEYS[1])
+    if ttl < 0 then
+        redis.call('PEXPIRE', KEYS[1], window)
+        ttl = window
+    end
+    return {count <= limit and 1 or 0, math.max(limit - count, 0), ttl}
+elseif mode == 'sliding' then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+    local count = redis.call('ZCARD', KEYS[1])
+    local allowed = 0
+    if count < limit then
+        redis.call('ZADD', KEYS[1], now, ARGV[4])
+        count = count + 1
+        allowed = 1
+    end
+    redis.call('PEXPIRE', KEYS[1], window)
+    local reset = window
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if oldest[2] then
+        reset = tonumber(oldest[2]) + window - now
+    end
+    return {allowed, limit - count, reset}
+else
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local rate = limit / window
+    local tokens = tonumber(bucket[1]) or limit
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(limit, tokens + (now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+    redis.call('PEXPIRE', KEYS[1], window)
+    return {allowed, math.floor(tokens), math.ceil(math.max(1 - tokens, 0) / rate)}
+end
+"""
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        if self.command_stack:
+            record_redis_round_trip()
+        return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(asyncio.Redis):
+    """每条命令、每次 pipeline 执行计为一次往返, 计入当前请求的指标 (/metrics)"""
+
+    async def execute_command(self, *args, **options):
+        record_redis_round_trip()
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    remaining: int
+    reset: timedelta  # time until the next attempt would be allowed / the window resets
 
 
 class RedisCache:
@@ -12,15 +101,47 @@ class RedisCache:
 
     def __init__(self) -> None:
         self.client = None
+        self._pid = None
+        self._rate_limit_script = None
 
     async def get_redis(self):
-        if self.client:
-            pong = await self.client.ping()
-            if pong:
-                return self.client
-        self.client = await asyncio.from_url(REDIS_URL, decode_responses=True, encoding="utf8")
+        # 连接池按进程创建, gunicorn fork 出的每个 worker 各自持有一个;
+        # 空闲连接由 health_check_interval 检测, 断线时自动重连重试, 不再每次调用都 PING
+        if self.client is None or self._pid != os.getpid():
+            pool = asyncio.ConnectionPool.from_url(
+                REDIS_URL,
+                decode_responses=True,
+                encoding="utf8",
+                max_connections=REDIS_MAX_CONNECTIONS,
+                health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                retry=Retry(ExponentialBackoff(), 3),
+                retry_on_error=[ConnectionError, TimeoutError],
+            )
+            self.client = InstrumentedRedis(connection_pool=pool)
+            self._pid = os.getpid()
+            # EVALSHA, falls back to loading the script when Redis does not know it yet
+            self._rate_limit_script = self.client.register_script(RATE_LIMIT_LUA)
         return self.client
 
+    def key(self, key: str) -> str:
+        """加上缓存前缀, 直接使用 client / pipeline 时需要"""
+        return f'{CACHE_HEADER}{key}'
+
+    @asynccontextmanager
+    async def pipeline(self, transaction: bool = True):
+        """
+        多条命令在一次往返内发送, 退出上下文时执行, 键名需要用 key() 加前缀:
+
+            async with cache_client.pipeline() as pipe:
+                pipe.set(cache_client.key('a'), 1)
+                pipe.delete(cache_client.key('b'))
+        """
+        client = await self.get_redis()
+        async with client.pipeline(transaction=transaction) as pipe:
+            yield pipe
+            await pipe.execute()
+
     async def set_cache(self, key: str, value, ex: timedelta = None) -> bool:
         await self.get_redis()
         if not all((key, value)):
@@ -36,32 +157,44 @@ class RedisCache:
             except:
                 pass
 
-        if isinstance(value, int | float | str):
+        # bytes 为已序列化的 json (json_dumps 的结果), 原样写入
+        if isinstance(value, int | float | str | bytes):
             return await self.client.set(**params)
         else:
             try:
                 params['value'] = json.dumps(value)
                 return await self.client.set(**params)
-            except json.JSONDecodeError:
+            except (TypeError, ValueError):
                 return False
 
     async def get_cache(self, key: str) -> str:
         await self.get_redis()
         return await self.client.get(f'{CACHE_HEADER}{key}')
 
-    async def del_cache(self, key: str) -> str:
+    async def del_cache(self, *keys: str) -> str:
         await self.get_redis()
-        return await self.client.delete(f'{CACHE_HEADER}{key}')
+        return await self.client.delete(*(f'{CACHE_HEADER}{key}' for key in keys))
 
-    async def limit_opt_cache(self, user_id: str, operation_type: UserOperation) -> str:
+    async def check_rate_limit(self, user_id: str, operation_type: UserOperation) -> RateLimitResult:
         """
-        increase operation times, return whether over time or not.
+        record one attempt of the operation atomically in a single round trip,
+        using the limit, window and mode configured in UserOperation.
         """
         await self.get_redis()
+        option = operation_type.value
         key = self.generate_user_operation_key(user_id, operation_type)
-        times = await self.client.incr(f'{CACHE_HEADER}{key}')
-        await self.expire_cache(key, operation_type.value.expire)
-        return times > operation_type.value.limit
+        window_ms = int(option.expire.total_seconds() * 1000)
+        allowed, remaining, reset_ms = await self._rate_limit_script(
+            keys=[self.key(key)], args=[option.mode.value, option.limit, window_ms, get_uuid4_id()]
+        )
+        return RateLimitResult(bool(allowed), int(remaining), timedelta(milliseconds=int(reset_ms)))
+
+    async def limit_opt_cache(self, user_id: str, operation_type: UserOperation) -> bool:
+        """
+        increase operation times, return whether over time or not.
+        """
+        result = await self.check_rate_limit(user_id, operation_type)
+        return not result.allowed
 
     async def clear_cache(self) -> str:
         await self.get_redis()
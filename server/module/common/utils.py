@@ -1,8 +1,12 @@
-from enum import Enum
+import base64
+from typing import Any
 
 from datetime import UTC, datetime, timedelta
 import uuid
 
+import orjson
+from pydantic import BaseModel as PydanticBaseModel
+
 
 def get_uuid4_id() -> str:
     return uuid.uuid4().hex
@@ -17,12 +21,41 @@ def get_now_str() -> str:
     return (get_now_UTC_time() + timedelta(hours=8)).strftime(r'%Y-%m-%d %H:%M:%S')
 
 
-def json_encoder(item):
-    if isinstance(item, Enum):
-        return item.value
+def json_default(item):
+    """orjson 不能直接序列化的类型: pydantic 模型按字段导出, 其他 (Decimal 等) 转为字符串"""
+    if isinstance(item, PydanticBaseModel):
+        return item.model_dump()
     return str(item)
 
 
+def json_dumps(value: Any) -> bytes:
+    """orjson 序列化, 原生支持 Enum / datetime / UUID, 字典的键可以不是字符串"""
+    return orjson.dumps(value, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def dump_model_row(obj) -> dict:
+    """按数据库列导出 ORM 实例, 用于写入缓存"""
+    return {column: getattr(obj, field) for field, column in obj._meta.fields_db_projection.items()}
+
+
+def load_model_row(model_cls, row: dict):
+    """把 dump_model_row 导出的数据(或其 json 形式)还原为 ORM 实例"""
+    meta = model_cls._meta
+    values = {}
+    for column, value in row.items():
+        field = meta.fields_map[meta.fields_db_projection_reverse[column]]
+        values[column] = field.to_python_value(value)
+    return model_cls._init_from_db(**values)
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """判断请求头 If-None-Match 是否命中当前 ETag (忽略弱校验前缀 W/)"""
+    if not if_none_match:
+        return False
+    candidates = [item.strip().removeprefix('W/') for item in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+
 def calc_division(dividend: float, divisor: float, percentage: float = 1):
     if dividend is None or divisor is None:
         return None
@@ -30,3 +63,24 @@ def calc_division(dividend: float, divisor: float, percentage: float = 1):
         return 0
     else:
         return dividend / divisor * percentage
+
+
+def encode_cursor(*values) -> str:
+    """把排序键编码为分页游标"""
+    return base64.urlsafe_b64encode(json_dumps(values)).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    """还原 encode_cursor 编码的排序键, 游标无效时抛出 ValueError"""
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError(cursor) from e
+    if not isinstance(values, list):
+        raise ValueError(cursor)
+    return values
+
+
+def escape_like(value: str) -> str:
+    """转义 LIKE 通配符, 配合 ESCAPE '\\' 使用"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
@@ -1,17 +1,22 @@
 from datetime import timedelta
 import random
 import string
-from fastapi import APIRouter
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, Response, status
 import pyotp
-from jose import jwt
+from tortoise.exceptions import IntegrityError
 
-from server.config.settings import ALGORITHM, DEBUG
-from server.module.common.email_utils import send_email
+from server.config.settings import DEBUG
+from server.module.common.db_routing import read_only_request
+from server.module.common.email_utils import enqueue_email
 from server.module.common.exceptions import AuthorizationFailed, BadRequest, NoPermission, TooManyRequest
 from server.module.common.global_variable import BaseResponse, DataResponse
-from server.module.common.utils import get_now_UTC_time
+from server.module.common.utils import etag_matches, get_now_UTC_time
 from server.module.order.models import Order
 from server.module.order.schemas import (
+    BatchOrderRequest,
+    BatchOrderTokenItem,
     BindRequest,
     CheckOrderExistRequest,
     OrderIdRequest,
@@ -20,7 +25,19 @@ from server.module.order.schemas import (
     TOTPSetupResponse,
     ToolDeviceBindRequest,
 )
-from server.module.order.utils import varify_code, verify_totp_code
+from server.module.order.utils import (
+    generate_order_token,
+    get_cached_order,
+    get_cached_order_by_email,
+    get_cached_orders,
+    invalidate_order_cache,
+    invalidate_order_device_index,
+    order_etag,
+    subscription_token_extra,
+    upsert_order_by_device,
+    varify_code,
+    verify_totp_code,
+)
 
 router = APIRouter()
 
@@ -37,6 +54,7 @@ async def setup_totp(request: OrderIdRequest):
     order.totp_secret = secret
     order.is_totp_enabled = False
     await order.save()
+    await invalidate_order_cache(order)
 
     uri = pyotp.totp.TOTP(secret).provisioning_uri(name=order.email, issuer_name=order.tool.name)
 
@@ -60,16 +78,10 @@ async def confirm_totp(request: TOTPConfirmRequest):
     order.is_totp_enabled = True
 
     await order.save()
-    await send_email(order.email, "Top Utils 绑定成功", "您的身份验证器已成功绑定。")
-
-    token_dict = {
-        'tool_code': order.tool_id,
-        'device_hash': order.device_info_hashed,
-        'order_id': order.id,
-        'email': order.email,
-        'expire_time': order.expire_time and order.expire_time.timestamp(),
-    }
-    encoded_jwt = jwt.encode(token_dict, '_'.join((order.tool_id, order.device_info_hashed, order.id, order.email)), algorithm=ALGORITHM)
+    await invalidate_order_cache(order)
+    await enqueue_email(order.email, "Top Utils 绑定成功", "您的身份验证器已成功绑定。")
+
+    encoded_jwt = generate_order_token(order)
     return DataResponse(data={'token': encoded_jwt})
 
 
@@ -78,7 +90,9 @@ async def software_login(request: BindRequest):
     """
     软件每次启动时调用此接口进行验证。
     """
-    order = await Order.get_or_none(id=request.order_id)
+    order = await get_cached_order(request.order_id)
+    if not order:
+        raise BadRequest("订单不存在")
 
     if not order.is_totp_enabled:
         raise BadRequest("请先绑定身份验证器")
@@ -91,14 +105,7 @@ async def software_login(request: BindRequest):
     if order.device_info_hashed != request.device_hash:
         raise NoPermission("设备不匹配，如果更换了设备，请使用换绑接口。")
 
-    token_dict = {
-        'tool_code': order.tool_id,
-        'device_hash': order.device_info_hashed,
-        'order_id': order.id,
-        'email': order.email,
-        'expire_time': order.expire_time and order.expire_time.timestamp(),
-    }
-    encoded_jwt = jwt.encode(token_dict, '_'.join((order.tool_id, order.device_info_hashed, order.id, order.email)), algorithm=ALGORITHM)
+    encoded_jwt = generate_order_token(order)
     return DataResponse(data={'token': encoded_jwt})
 
 
@@ -118,8 +125,9 @@ async def send_email_code(request: OrderIdRequest):
     order.email_verify_code = code
     order.email_verify_expire = get_now_UTC_time() + timedelta(minutes=10)  # 验证码有效期为5分钟
     await order.save()
+    await invalidate_order_cache(order)
 
-    await send_email(order.email, "Top Utils 验证码", f"您的验证码是：{code}，请在5分钟内使用。")
+    await enqueue_email(order.email, "Top Utils 验证码", f"您的验证码是：{code}，请在5分钟内使用。")
 
     return BaseResponse("验证码已发送，请查收您的邮箱。")
 
@@ -146,20 +154,15 @@ async def rebind_device(request: ReBindRequest):
     
     # 执行换绑
     await Order.filter(id=request.order_id).delete()  # 删除当前设备的订单记录
+    old_device_hash = old_order.device_info_hashed
     old_order.device_info_hashed = request.device_hash
     old_order.last_rebind_time = get_now_UTC_time()
     await old_order.save()
+    await invalidate_order_cache(request.order_id, old_order)
+    if old_device_hash:
+        await invalidate_order_device_index(old_order.tool_id, old_device_hash)
 
-    token_dict = {
-        'tool_code': old_order.tool_id,
-        'device_hash': old_order.device_info_hashed,
-        'order_id': old_order.id,
-        'email': old_order.email,
-        'expire_time': old_order.expire_time.timestamp(),
-    }
-    encoded_jwt = jwt.encode(
-        token_dict, '_'.join((old_order.tool_id, old_order.device_info_hashed, old_order.id, old_order.email)), algorithm=ALGORITHM
-    )
+    encoded_jwt = generate_order_token(old_order)
     return DataResponse(data={'token': encoded_jwt})
 
 
@@ -168,48 +171,42 @@ async def bind_device(request: ToolDeviceBindRequest):
     """
     当用户在已绑定设备之外的电脑上登录时，调用此接口进行换绑。
     """
-    order = await Order.get_or_none(device_info_hashed=request.device_hash, tool_id=request.tool_code)
-    if order:
-        # if not order.is_active:
-        #     raise BadRequest("试用期已结束或订阅过期, 请先续费")
-        pass
-    else:
-        order = await Order.create(device_info_hashed=request.device_hash, tool_id=request.tool_code)
+    try:
+        order_id = await upsert_order_by_device(request.tool_code, request.device_hash)
+    except IntegrityError:
+        raise BadRequest("工具不存在")
 
-    return DataResponse(data={'order_id': order.id})
+    return DataResponse(data={'order_id': order_id})
 
 
-@router.post("/is-valid", summary="设备工具绑定接口")
-async def is_valid(request: OrderIdRequest):
+@router.post("/is-valid", summary="设备工具绑定接口", dependencies=[Depends(read_only_request)])
+async def is_valid(request: OrderIdRequest, if_none_match: Optional[str] = Header(None)):
     """
     当用户在已绑定设备之外的电脑上登录时，调用此接口进行换绑。
+    订单未变化时 (If-None-Match 命中) 直接返回 304, 客户端沿用上次的令牌。
     """
-    order = await Order.get_or_none(id=request.order_id)
+    order = await get_cached_order(request.order_id)
     if not order:
         raise BadRequest("订单不存在")
-    token_dict = {
-        'tool_code': order.tool_id,
-        'device_hash': order.device_info_hashed,
-        'order_id': order.id,
-        'email': order.email,
-        'expire_time': order.expire_time and order.expire_time.timestamp(),
-    }
-    encoded_jwt = jwt.encode(token_dict, '_'.join((order.tool_id, order.device_info_hashed, order.id)), algorithm=ALGORITHM)
-    return DataResponse(data={'token': encoded_jwt})
+    etag = order_etag(order, 'is-valid')
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    encoded_jwt = generate_order_token(order, with_email=False)
+    return DataResponse(data={'token': encoded_jwt}, headers={'ETag': etag})
 
 
-@router.post("/check-order-exist", summary="检查邮箱状态接口")
+@router.post("/check-order-exist", summary="检查邮箱状态接口", dependencies=[Depends(read_only_request)])
 async def check_order_exist(request: CheckOrderExistRequest):
     """
     检查用户邮箱状态，是否已绑定身份验证器。
     """
-    org_order = await Order.get_or_none(email=request.email, tool_id=request.tool_code)
+    org_order = await get_cached_order_by_email(request.tool_code, request.email)
     if not org_order:
         return DataResponse(message="欢迎新用户", data={"status": "ok", "existing_order_id": None})
 
-    new_order = await Order.get_or_none(
-        device_info_hashed=request.current_device_hash, tool_id=request.tool_code, id=request.current_order_id
-    )
+    new_order = await get_cached_order(request.current_order_id)
+    if new_order and (new_order.device_info_hashed != request.current_device_hash or new_order.tool_id != request.tool_code):
+        new_order = None
     if not new_order:
         raise BadRequest("当前设备未绑定任何订单")
 
@@ -222,28 +219,72 @@ async def check_order_exist(request: CheckOrderExistRequest):
 
 
 @router.post('/sub-check', summary="启动脚本时检查订阅")
-async def check_subscription_status(request: OrderIdRequest):
+async def check_subscription_status(request: OrderIdRequest, if_none_match: Optional[str] = Header(None)):
     """
     运行脚本时检查订阅状态。
+    订单未变化、仍有效且提醒状态不变时 (If-None-Match 命中) 直接返回 304, 剩余时间由客户端按 expire_time 计算。
     """
-    order = await Order.get_or_none(id=request.order_id)
+    order = await get_cached_order(request.order_id)
     utc_now = get_now_UTC_time()
     if not order:
         raise BadRequest("订单不存在")
 
     if not order.expire_time:
-        order.expire_time = utc_now + timedelta(minutes=5)  # 5分钟试用期
-        await order.save()
+        # order 来自缓存, 只更新试用期相关的列, 不把可能过期的其他列写回; 并发请求只有一个开通试用
+        trial_expire_time = utc_now + timedelta(minutes=5)  # 5分钟试用期
+        updated = await Order.filter(id=order.id, expire_time__isnull=True).update(expire_time=trial_expire_time, update_time=utc_now)
+        await invalidate_order_cache(order)
+        if updated:
+            order.expire_time = trial_expire_time
+            order.update_time = utc_now
+        else:
+            order = await Order.get(id=order.id)
     if not order.is_active:
         raise BadRequest("试用期已结束或订阅过期, 请先续费")
-    token_dict = {
-        'tool_code': order.tool_id,
-        'device_hash': order.device_info_hashed,
-        'order_id': order.id,
-        'email': order.email,
-        'expire_time': order.expire_time and order.expire_time.timestamp(),
-        'rest_time': (order.expire_time - utc_now).seconds,
-        'reminder': (order.expire_time - utc_now) <= timedelta(minutes=5),  # 是否需要提醒,
-    }
-    encoded_jwt = jwt.encode(token_dict, '_'.join((order.tool_id, order.device_info_hashed, order.id, order.email)), algorithm=ALGORITHM)
-    return DataResponse(data={'token': encoded_jwt})
+    token_extra = subscription_token_extra(order, utc_now)
+    # 令牌中的 reminder 随时间变化, 进入提醒期后 ETag 随之改变, 客户端拿到带提醒的新令牌
+    etag = order_etag(order, f"sub-check.{int(token_extra['reminder'])}")
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    encoded_jwt = generate_order_token(order, **token_extra)
+    return DataResponse(data={'token': encoded_jwt}, headers={'ETag': etag})
+
+
+@router.post('/sub-check/batch', summary="批量检查同一设备上多个订单的订阅")
+async def batch_check_subscription_status(request: BatchOrderRequest):
+    """
+    同一台机器运行多个工具时, 一次请求检查所有订单的订阅状态。
+    订单与单个检查一样经订单缓存读取, 未命中的订单通过一次 IN 查询读取, 每个订单各自返回令牌或错误信息。
+    """
+    device_hashes = {item.order_id: item.device_hash for item in request.orders}
+    orders = await get_cached_orders(list(device_hashes))
+    utc_now = get_now_UTC_time()
+
+    # 未开始试用的订单统一用一条 UPDATE 开通试用
+    trial_ids = [order_id for order_id, order in orders.items() if not order.expire_time and order.device_info_hashed == device_hashes[order_id]]
+    if trial_ids:
+        trial_expire_time = utc_now + timedelta(minutes=5)  # 5分钟试用期
+        updated = await Order.filter(id__in=trial_ids, expire_time__isnull=True).update(expire_time=trial_expire_time, update_time=utc_now)
+        await invalidate_order_cache(*trial_ids)
+        if updated == len(trial_ids):
+            for order_id in trial_ids:
+                orders[order_id].expire_time = trial_expire_time
+                orders[order_id].update_time = utc_now
+        else:
+            # 部分订单已被并发请求开通试用 (或已被删除), 不知道是哪些, 从主库重新读取这些订单
+            orders.update((order_id, None) for order_id in trial_ids)
+            orders.update((order.id, order) for order in await Order.filter(id__in=trial_ids))
+
+    results = []
+    for order_id, device_hash in device_hashes.items():
+        order = orders.get(order_id)
+        if not order:
+            results.append(BatchOrderTokenItem(order_id=order_id, error="订单不存在"))
+        elif order.device_info_hashed != device_hash:
+            results.append(BatchOrderTokenItem(order_id=order_id, error="设备不匹配"))
+        elif not order.is_active:
+            results.append(BatchOrderTokenItem(order_id=order_id, error="试用期已结束或订阅过期, 请先续费"))
+        else:
+            token = generate_order_token(order, **subscription_token_extra(order, utc_now))
+            results.append(BatchOrderTokenItem(order_id=order_id, token=token))
+    return DataResponse(data=[item.model_dump() for item in results])
@@ -62,5 +62,10 @@ class Order(BaseModel):
         return f"Order(id={self.id}, tool={self.tool.name}, status={self.paid_status.name})"
 
 
-# 创建 Pydantic 模型用于 API 输出
-Order_Pydantic = pydantic_model_creator(Order)
+def __getattr__(name: str):
+    # Pydantic 输出模型 Order_Pydantic 在首次使用时创建, 此时 Tortoise 已初始化, 关联字段可以解析
+    if name != 'Order_Pydantic':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    model = pydantic_model_creator(Order, name='Order_Pydantic')
+    globals()[name] = model
+    return model
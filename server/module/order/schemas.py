@@ -1,4 +1,6 @@
 # schemas.py
+from typing import Optional
+
 from pydantic import BaseModel, EmailStr, Field
 
 
@@ -47,3 +49,16 @@ class TOTPSetupResponse(BaseModel):
 class CheckOrderExistRequest(EmailRequest, ToolCodeRequest):
     current_order_id: str
     current_device_hash: str
+
+
+class OrderDeviceRequest(OrderIdRequest, DeviceHashRequest): ...
+
+
+class BatchOrderRequest(BaseModel):
+    orders: list[OrderDeviceRequest] = Field(..., min_length=1, max_length=32, description="同一台机器上的多个订单")
+
+
+class BatchOrderTokenItem(BaseModel):
+    order_id: str
+    token: Optional[str] = None
+    error: Optional[str] = None
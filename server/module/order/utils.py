@@ -1,10 +1,22 @@
+import hashlib
+from datetime import timedelta
+
+import orjson
 import pyotp
+from jose import jwt
 
-from server.config.settings import DEBUG
+from server.config.settings import ALGORITHM, DEBUG, ORDER_TOKEN_ALGORITHM, ORDER_TOKEN_LIFETIME_HOURS, ORDER_TOKEN_PRIVATE_KEY
 from server.module.common.exceptions import AuthorizationFailed, BadRequest
-from server.module.common.utils import get_now_UTC_time
+from server.module.common.db_routing import mark_written, read_db
+from server.module.common.lru_cache import LRUCache
+from server.module.common.redis_client import cache_client
+from server.module.common.utils import dump_model_row, get_now_UTC_time, get_uuid4_id, json_dumps, load_model_row
 from server.module.order.models import Order
 
+ORDER_CACHE_EXPIRE = timedelta(minutes=10)  # Redis 中订单缓存的有效期
+# 进程内缓存只挡住短时间内的重复心跳, TTL 很短, 其他 worker 的写入最多延迟这么久可见
+_local_order_cache = LRUCache(maxsize=4096, ttl=3)
+
 
 def verify_totp_code(secret: str, code: str) -> bool:
     """验证TOTP动态码"""
@@ -22,13 +34,222 @@ async def varify_code(check_method: int, old_order: Order, code: str) -> bool:
             return AuthorizationFailed("动态码错误")
     elif check_method == 2:
         code = code.strip().upper()  # 确保验证码是大写
-        if not old_order.email_verify_code:
-            return BadRequest("请先发送验证码邮件")
-        if old_order.email_verify_code != code or old_order.email_verify_expire < get_now_UTC_time():
-            return BadRequest("验证码错误或失效")
-        old_order.email_verify_code = None  # 验证成功后清除验证码
+        # old_order 可能来自缓存, 验证码以数据库为准: 条件更新同时完成校验和清除, 验证码只能使用一次
+        utc_now = get_now_UTC_time()
+        updated = await Order.filter(id=old_order.id, email_verify_code=code, email_verify_expire__gte=utc_now).update(
+            email_verify_code=None, email_verify_expire=None, update_time=utc_now
+        )
+        if not updated:
+            # 区分从未发送与输错/过期, 只在校验失败时多查一次
+            sent_code = await Order.filter(id=old_order.id).first().values_list('email_verify_code', flat=True)
+            return BadRequest("验证码错误或失效" if sent_code else "请先发送验证码邮件")
+        old_order.email_verify_code = None
         old_order.email_verify_expire = None
-        await old_order.save()
+        old_order.update_time = utc_now
+        await invalidate_order_cache(old_order)
     else:
         return BadRequest("无效的验证方式")
     return True
+
+
+def generate_order_token(order: Order, with_email: bool = True, **extra) -> str:
+    """
+    生成返回给客户端的订单令牌。
+    配置了私钥时使用非对称签名并携带 not_after, 客户端在 not_after 之前可离线校验;
+    否则密钥由 tool_id + device_hash + order_id (+ email) 组成。
+    """
+    token_dict = {
+        'tool_code': order.tool_id,
+        'device_hash': order.device_info_hashed,
+        'order_id': order.id,
+        'email': order.email,
+        'expire_time': order.expire_time and order.expire_time.timestamp(),
+        **extra,
+    }
+    if ORDER_TOKEN_PRIVATE_KEY:
+        not_after = int((get_now_UTC_time() + timedelta(hours=ORDER_TOKEN_LIFETIME_HOURS)).timestamp())
+        token_dict.update({'not_after': not_after, 'exp': not_after})
+        return jwt.encode(token_dict, ORDER_TOKEN_PRIVATE_KEY, algorithm=ORDER_TOKEN_ALGORITHM)
+
+    key_parts = [order.tool_id, order.device_info_hashed, order.id]
+    if with_email:
+        key_parts.append(order.email or '')
+    return jwt.encode(token_dict, '_'.join(key_parts), algorithm=ALGORITHM)
+
+
+def order_etag(order: Order, variant: str = '') -> str:
+    """由订单 update_time 派生的 ETag, 订单任何写入都会改变它"""
+    version = f'{order.id}.{order.update_time.timestamp()}.{ORDER_TOKEN_ALGORITHM}.{variant}'
+    return f'"{hashlib.sha1(version.encode()).hexdigest()}"'
+
+
+def subscription_token_extra(order: Order, utc_now) -> dict:
+    """订阅检查令牌额外携带的剩余时间与提醒标记"""
+    return {
+        'rest_time': (order.expire_time - utc_now).seconds,
+        'reminder': (order.expire_time - utc_now) <= timedelta(minutes=5),  # 是否需要提醒
+    }
+
+
+def _order_id_key(order_id: str) -> str:
+    return f'order.id.{order_id}'
+
+
+def _order_device_key(tool_id: str, device_hash: str) -> str:
+    return f'order.device.{tool_id}.{device_hash}'
+
+
+def _order_email_key(tool_id: str, email: str) -> str:
+    return f'order.email.{tool_id}.{email}'
+
+
+async def cache_order(*orders: Order) -> None:
+    """把订单写入两级缓存, 同时写入 (tool, device) / (tool, email) 到订单 id 的索引, 多个订单一次往返写入"""
+    if not orders:
+        return
+    async with cache_client.pipeline(transaction=False) as pipe:
+        for order in orders:
+            row = dump_model_row(order)
+            key = _order_id_key(order.id)
+            _local_order_cache.set(key, row)
+            pipe.set(cache_client.key(key), json_dumps(row), ex=ORDER_CACHE_EXPIRE)
+            if order.device_info_hashed:
+                pipe.set(cache_client.key(_order_device_key(order.tool_id, order.device_info_hashed)), order.id, ex=ORDER_CACHE_EXPIRE)
+            if order.email:
+                pipe.set(cache_client.key(_order_email_key(order.tool_id, order.email)), order.id, ex=ORDER_CACHE_EXPIRE)
+
+
+async def invalidate_order_cache(*orders: Order | str) -> None:
+    """订单写入/删除后调用, 清除订单本身及其索引的缓存, 并让这些键近期的读取走主库"""
+    keys = []
+    for order in orders:
+        if isinstance(order, str):
+            keys.append(_order_id_key(order))
+            continue
+        keys.append(_order_id_key(order.id))
+        if order.device_info_hashed:
+            keys.append(_order_device_key(order.tool_id, order.device_info_hashed))
+        if order.email:
+            keys.append(_order_email_key(order.tool_id, order.email))
+    await _invalidate_keys(*keys)
+
+
+async def invalidate_order_device_index(tool_id: str, device_hash: str) -> None:
+    """订单换绑设备后调用, 清除旧设备到该订单的索引; 订单本身和新设备的索引仍由 invalidate_order_cache 清除"""
+    await _invalidate_keys(_order_device_key(tool_id, device_hash))
+
+
+async def _invalidate_keys(*keys: str) -> None:
+    if not keys:
+        return
+    _local_order_cache.pop(*keys)
+    await cache_client.del_cache(*keys)
+    await mark_written(*keys)
+
+
+async def get_cached_order(order_id: str) -> Order | None:
+    """
+    按 id 读取订单: 进程内 LRU -> Redis -> 数据库 (只读请求中为副本)。
+    每次返回新的实例, 调用方修改并 save 后必须调用 invalidate_order_cache。
+    """
+    key = _order_id_key(order_id)
+    row = _local_order_cache.get(key)
+    if row is None:
+        cached = await cache_client.get_cache(key)
+        if not cached:
+            order = await Order.get_or_none(id=order_id, using_db=await read_db(key))
+            if order:
+                await cache_order(order)
+            return order
+        row = orjson.loads(cached)
+        _local_order_cache.set(key, row)
+    return load_model_row(Order, row)
+
+
+async def get_cached_orders(order_ids: list[str]) -> dict[str, Order]:
+    """
+    批量读取订单: 进程内 LRU -> 一次 Redis MGET -> 一次数据库 IN 查询, 从数据库读到的订单写回缓存。
+    返回 {订单 id: 订单}, 不存在的订单不在结果中; 与 get_cached_order 一样每次返回新的实例。
+    """
+    rows = {}
+    missing = []
+    for order_id in order_ids:
+        row = _local_order_cache.get(_order_id_key(order_id))
+        if row is None:
+            missing.append(order_id)
+        else:
+            rows[order_id] = row
+
+    db_ids = []
+    if missing:
+        redis = await cache_client.get_redis()
+        for order_id, cached in zip(missing, await redis.mget([cache_client.key(_order_id_key(order_id)) for order_id in missing])):
+            if cached:
+                rows[order_id] = orjson.loads(cached)
+                _local_order_cache.set(_order_id_key(order_id), rows[order_id])
+            else:
+                db_ids.append(order_id)
+
+    orders = {order_id: load_model_row(Order, row) for order_id, row in rows.items()}
+    if db_ids:
+        db = await read_db(*(_order_id_key(order_id) for order_id in db_ids))
+        fetched = await Order.filter(id__in=db_ids).using_db(db)
+        await cache_order(*fetched)
+        orders.update((order.id, order) for order in fetched)
+    return orders
+
+
+async def _lookup_order_index(key: str, **filters) -> Order | None:
+    """只查缓存索引, 不回源数据库"""
+    order_id = _local_order_cache.get(key) or await cache_client.get_cache(key)
+    if order_id:
+        order = await get_cached_order(order_id)
+        # 索引可能指向已换绑/已删除的订单, 校验不通过视为未命中
+        if order and all(getattr(order, field) == value for field, value in filters.items()):
+            _local_order_cache.set(key, order_id)
+            return order
+        _local_order_cache.pop(key)
+    return None
+
+
+async def _get_cached_order_by_index(key: str, **filters) -> Order | None:
+    order = await _lookup_order_index(key, **filters)
+    if order:
+        return order
+
+    order = await Order.get_or_none(**filters, using_db=await read_db(key))
+    if order:
+        await cache_order(order)
+    return order
+
+
+async def get_cached_order_by_device(tool_id: str, device_hash: str) -> Order | None:
+    return await _get_cached_order_by_index(_order_device_key(tool_id, device_hash), tool_id=tool_id, device_info_hashed=device_hash)
+
+
+async def get_cached_order_by_email(tool_id: str, email: str) -> Order | None:
+    return await _get_cached_order_by_index(_order_email_key(tool_id, email), tool_id=tool_id, email=email)
+
+
+UPSERT_ORDER_BY_DEVICE_SQL = """
+INSERT INTO "tb_order" ("id", "tool_id", "device_info_hashed") VALUES ($1, $2, $3)
+ON CONFLICT ("tool_id", "device_info_hashed") DO UPDATE SET "device_info_hashed" = EXCLUDED."device_info_hashed"
+RETURNING "id"
+"""
+
+
+async def upsert_order_by_device(tool_id: str, device_hash: str) -> str:
+    """
+    设备绑定: 缓存命中直接返回订单 id, 否则用一条 INSERT ... ON CONFLICT 语句创建或取回订单,
+    客户端并发重试也不会触发唯一约束错误。
+    """
+    key = _order_device_key(tool_id, device_hash)
+    order = await _lookup_order_index(key, tool_id=tool_id, device_info_hashed=device_hash)
+    if order:
+        return order.id
+
+    rows = await Order._meta.db.execute_query_dict(UPSERT_ORDER_BY_DEVICE_SQL, [get_uuid4_id(), tool_id, device_hash])
+    order_id = rows[0]['id']
+    _local_order_cache.set(key, order_id)
+    await cache_client.set_cache(key, order_id, ORDER_CACHE_EXPIRE)
+    return order_id
@@ -1,32 +1,46 @@
+import asyncio
+import os
 from datetime import timedelta
 from typing import Optional
-from uuid import uuid4
 
-from fastapi import APIRouter, Depends, Request, UploadFile
+from fastapi import APIRouter, Depends, Query, Request, UploadFile
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from tortoise.backends.base.client import BaseDBAsyncClient
 from tortoise.expressions import Q
 
-from server.config.settings import ACCESS_TOKEN_EXPIRE_DAYS, DEBUG, DEV
+from server.config.settings import ACCESS_TOKEN_EXPIRE_DAYS, AVATAR_MAX_SIZE, AVATAR_THUMBNAIL_SIZES, DEBUG, DEV
 from server.module.common.accepts import SuccessResponse
-from server.module.common.constrants import AVATAR_STATIC_PATH, DEFALT_PASSWORD, DEBUG_PASSWORD
+from server.module.common.constrants import AVATAR_EXTENSIONS, AVATAR_STATIC_PATH, DEFALT_PASSWORD, DEBUG_PASSWORD, FIRST_LOAD_SIZE, MAX_PAGE_SIZE
+from server.module.common.db_routing import read_db, read_only_request, user_scope
 from server.module.common.exceptions import BadRequest, NoPermission, TooManyRequest
+from server.module.common.file_utils import generate_thumbnails, save_upload
 from server.module.common.global_variable import DataResponse
 from server.module.common.pydantics import UserOperation
 from server.module.common.redis_client import cache_client
-from server.module.common.utils import get_now_UTC_time
+from server.module.common.utils import decode_cursor, encode_cursor, get_now_UTC_time
 from server.module.user.models import User
+from server.module.user import schemas
 from server.module.user.schemas import (
     TokenPydantic,
     UserCreatePydantic,
-    UserDetailORMPydantic,
     UserDisablePydantic,
     UserEditPydantic,
-    UserInfoORMPydantic,
+    UserListPydantic,
     UserModifyPasswordPydantic,
-    UserPydantic,
     UserResetPasswordPydantic,
 )
-from server.module.user.utils import create_access_token, current_user, get_password_hash, verify_password
+from server.module.user.utils import (
+    create_access_token,
+    current_user,
+    get_password_hash_async,
+    get_user_epoch,
+    invalidate_principal,
+    normalize_client_ip,
+    revoke_user_tokens,
+    search_users,
+    verify_password_async,
+)
 
 router = APIRouter()
 
@@ -44,27 +58,36 @@ async def post_token(request: Request, user: OAuth2PasswordRequestForm = Depends
         ...
     elif DEBUG and user.password == DEBUG_PASSWORD:
         prompt_type = 2
-    elif not verify_password(user.password, user_obj.password):
-        if await cache_client.limit_opt_cache(user_obj.id, UserOperation.TRY_PASSWORD):
-            raise TooManyRequest('密码尝试次数过多, 请5分钟后重试')
-        raise BadRequest('密码错误')
+    else:
+        is_valid, new_hash = await verify_password_async(user.password, user_obj.password)
+        if not is_valid:
+            if await cache_client.limit_opt_cache(user_obj.id, UserOperation.TRY_PASSWORD):
+                raise TooManyRequest('密码尝试次数过多, 请5分钟后重试')
+            raise BadRequest('密码错误')
+        if new_hash:
+            # argon2 parameters changed since this hash was created
+            user_obj.password = new_hash
 
     if user_obj.disabled:
         if await cache_client.limit_opt_cache(user_obj.id, UserOperation.TRY_PASSWORD):
             raise TooManyRequest('密码尝试次数过多, 请5分钟后重试')
         raise NoPermission('账户异常, 无法登录')
-    token = create_access_token({'user_id': user_obj.id, 'username': user_obj.username, 'role': user_obj.role_id})
+    token = create_access_token(
+        {'user_id': user_obj.id, 'username': user_obj.username, 'role': user_obj.role_id, 'epoch': await get_user_epoch(user_obj.id)}
+    )
 
     # get user last login ip
     if DEBUG:
-        user_obj.last_login_ip = request.client.host
+        user_obj.last_login_ip = normalize_client_ip(request.client.host)
     else:
-        user_obj.last_login_ip = request.headers.get("X-Forwarded-For")
+        user_obj.last_login_ip = normalize_client_ip(request.headers.get("X-Forwarded-For"))
     user_obj.last_login_time = get_now_UTC_time()
     await user_obj.save()
-    await cache_client.set_cache(str(user_obj.id), token, timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
-    # clear try password times
-    await cache_client.del_cache(cache_client.generate_user_operation_key(str(user_obj.id), UserOperation.TRY_PASSWORD))
+    async with cache_client.pipeline() as pipe:
+        pipe.set(cache_client.key(str(user_obj.id)), token, ex=timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
+        # clear try password times
+        pipe.delete(cache_client.key(cache_client.generate_user_operation_key(str(user_obj.id), UserOperation.TRY_PASSWORD)))
+    await invalidate_principal(user_obj.id)
     if user.password == DEFALT_PASSWORD:
         prompt_type = 1
     return TokenPydantic(access_token=token, prompt_type=prompt_type)
@@ -79,39 +102,90 @@ async def post_token(request: Request, user: OAuth2PasswordRequestForm = Depends
 @router.post('/logout/')
 async def post_logout(me: User = Depends(current_user)):
     await cache_client.del_cache(str(me.id))
+    await revoke_user_tokens(me.id)
     return SuccessResponse()
 
 
-@router.get('/')
+@router.get('/', dependencies=[Depends(read_only_request)])
 async def get_user_info(user_id: Optional[str] = None, me: User = Depends(current_user)):
     if user_id:
-        data = await UserInfoORMPydantic.from_queryset_single(User.get_or_none(id=user_id))
+        db = await read_db(user_scope(me.id), user_scope(user_id))
+        data = await schemas.UserInfoORMPydantic.from_queryset_single(User.get_or_none(id=user_id, using_db=db))
     else:
         data = {
-            'userinfo': UserDetailORMPydantic.model_validate(me),
+            'userinfo': schemas.UserDetailORMPydantic.model_validate(me),
         }
 
     return DataResponse(data=data)
 
 
-@router.get('/list/')
-async def get_user_list(query: Optional[str] = None, me: User = Depends(current_user)):
-    users = (
-        User.all().exclude(username='admin').order_by('role_id', 'user_group__group_id', '-user_group__is_leader', '-standard_workday')
-    )  # 排除系统管理员的所有账号
-    if users and query:
-        users = users.filter(Q(nickname__icontains=query) | Q(email__icontains=query) | Q(phone__icontains=query)).distinct()
-    # 暂时无需分页
-    # users = users.offset((pageNum - 1) * pageSize).limit(pageSize)
-    users = [UserPydantic.model_validate(u) for u in await users]
-    return DataResponse(data=users)
+def _user_list_queryset(query: Optional[str], after: Optional[tuple[str, int]], limit: int, db: BaseDBAsyncClient):
+    users = User.all(using_db=db).exclude(username='admin')  # 排除系统管理员的所有账号
+    if query:
+        users = users.filter(Q(nickname__icontains=query) | Q(email__icontains=query) | Q(phone__icontains=query))
+    if after:
+        nickname, user_id = after
+        # nickname__gte 给出 (nickname, id) 索引扫描的起点, OR 条件等价于 (nickname, id) > (nickname, user_id)
+        users = users.filter(Q(nickname__gte=nickname) & (Q(nickname__gt=nickname) | Q(nickname=nickname, id__gt=user_id)))
+    return users.order_by('nickname', 'id').limit(limit)
+
+
+async def _stream_user_list(query: Optional[str], after: Optional[tuple[str, int]], db: BaseDBAsyncClient):
+    """逐页查询并逐行输出, 内存中最多只有一页用户"""
+    while True:
+        users = await _user_list_queryset(query, after, MAX_PAGE_SIZE, db)
+        for user in users:
+            yield UserListPydantic.model_validate(user).model_dump_json() + '\n'
+        if len(users) < MAX_PAGE_SIZE:
+            return
+        after = (users[-1].nickname, users[-1].id)
+
+
+@router.get('/list/', dependencies=[Depends(read_only_request)])
+async def get_user_list(
+    query: Optional[str] = None,
+    cursor: Optional[str] = None,
+    size: int = Query(FIRST_LOAD_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = False,
+    me: User = Depends(current_user),
+):
+    """
+    按 (nickname, id) 游标分页, 返回 {'users': [...], 'next_cursor': 下一页的游标, 最后一页为 null}。
+    指定 query 时走 pg_trgm 索引搜索, 按相似度排序返回前 size 条, 不分页。
+    stream=true 时忽略 size, 以 NDJSON 逐行输出所有匹配的用户, 用于导出。
+    """
+    after = None
+    if cursor:
+        try:
+            nickname, user_id = decode_cursor(cursor)
+            after = (str(nickname), int(user_id))
+        except (ValueError, TypeError):
+            raise BadRequest('无效的分页游标')
+
+    # 本用户刚修改过数据时读主库
+    db = await read_db(user_scope(me.id))
+    if stream:
+        return StreamingResponse(_stream_user_list(query, after, db), media_type='application/x-ndjson')
+
+    if query:
+        users = await search_users(query, size, db)
+        return DataResponse(data={'users': [UserListPydantic.model_validate(u) for u in users], 'next_cursor': None})
+
+    users = await _user_list_queryset(query, after, size + 1, db)
+    next_cursor = None
+    if len(users) > size:
+        users = users[:size]
+        next_cursor = encode_cursor(users[-1].nickname, users[-1].id)
+    return DataResponse(data={'users': [UserListPydantic.model_validate(u) for u in users], 'next_cursor': next_cursor})
 
 
 @router.post('/create/')
 # async def post_create_user(user: UserCreatePydantic, me: User = Depends(current_user)):
 async def post_create_user(user: UserCreatePydantic):
     """admin and system admin can create user"""
-    user = await User.create(**user.model_dump())
+    data = user.model_dump()
+    data['password'] = await get_password_hash_async(user.password or DEFALT_PASSWORD)
+    user = await User.create(**data)
     return SuccessResponse()
 
 
@@ -125,60 +199,75 @@ async def post_create_user(param: UserResetPasswordPydantic, me: User = Depends(
     """
     user_obj = await User.get_or_none(id=param.user_id)
     if user_obj:
-        user_obj.password = get_password_hash(DEFALT_PASSWORD)
+        user_obj.password = await get_password_hash_async(DEFALT_PASSWORD)
         await user_obj.save()
-        return UserInfoORMPydantic.model_validate(user_obj)
+        await revoke_user_tokens(user_obj.id)
+        return schemas.UserInfoORMPydantic.model_validate(user_obj)
     raise BadRequest('用户不存在')
 
 
 @router.post('/avatar/upload/')
 async def post_upload_template(file: UploadFile, me: User = Depends(current_user)):
-    """upload parameters by excel filter"""
-    origin_ext = '.' + file.name.split('.')[-1]
-    filename = uuid4().hex + origin_ext
-    with open(AVATAR_STATIC_PATH / filename, 'wb') as f:
-        f.write(await file.read())
-    return DataResponse(data={'filename': filename})
+    """upload avatar in chunks, then derive square thumbnails next to it"""
+    origin_ext = os.path.splitext(file.filename or '')[1].lower()
+    if origin_ext not in AVATAR_EXTENSIONS:
+        raise BadRequest(f'仅支持 {"/".join(AVATAR_EXTENSIONS)} 格式的图片')
+    filename = await save_upload(file, AVATAR_STATIC_PATH, origin_ext, AVATAR_MAX_SIZE)
+    path = AVATAR_STATIC_PATH / filename
+    try:
+        thumbnails = await generate_thumbnails(path, AVATAR_THUMBNAIL_SIZES)
+    except BadRequest:
+        await asyncio.to_thread(path.unlink, missing_ok=True)
+        raise
+    return DataResponse(data={'filename': filename, 'thumbnails': thumbnails})
 
 
 @router.put('/edit/')
 async def put_edit_info(params: UserEditPydantic, me: User = Depends(current_user)):
     """user edit info"""
-    user_obj = me
+    # me comes from the principal cache and may be stale, edit a fresh row and write back only the edited columns
+    user_obj = await User.get(id=me.id)
+    update_fields = ['update_time']
     if params.nickname:
         user_obj.nickname = params.nickname
+        update_fields.append('nickname')
     if params.avatar:
         user_obj.avatar = params.avatar
+        update_fields.append('avatar')
     if params.phone:
         if not user_obj.phone:
             user_obj.phone = params.phone
+            update_fields.append('phone')
         else:
             raise BadRequest('电话号码不能修改, 请联系管理员')
     if params.email:
         if not user_obj.email:
             user_obj.email = params.email
+            update_fields.append('email')
         else:
             raise BadRequest('电子邮箱不能修改, 请联系管理员')
     if await cache_client.limit_opt_cache(str(user_obj.id), UserOperation.EDIT_INFO):
         raise TooManyRequest('修改失败, 请30分钟之后再试')
-    await user_obj.save()
-    return DataResponse(data=UserInfoORMPydantic.model_validate(me))
+    await user_obj.save(update_fields=update_fields)
+    await invalidate_principal(user_obj.id)
+    return DataResponse(data=schemas.UserInfoORMPydantic.model_validate(user_obj))
 
 
 @router.put('/password/modify/')
 async def put_modify_password(param: UserModifyPasswordPydantic, me: User = Depends(current_user)):
     """user modify password by self."""
-    if not verify_password(param.old_password, me.password):
+    is_valid, _ = await verify_password_async(param.old_password, me.password)
+    if not is_valid:
         if await cache_client.limit_opt_cache(me.id, UserOperation.TRY_PASSWORD):
             raise TooManyRequest('密码尝试次数过多, 请5分钟后重试')
         raise BadRequest('原密码错误')
     if param.old_password == param.new_password:
         raise BadRequest('新密码不能与原密码相同')
-    me.password = get_password_hash(param.new_password)
-    await me.save()
-    # clear try password times
-    await cache_client.del_cache(cache_client.generate_user_operation_key(str(me.id), UserOperation.TRY_PASSWORD))
-    await cache_client.del_cache(str(me.id))  # clear login status
+    # only the password column, me is the cached principal
+    await User.filter(id=me.id).update(password=await get_password_hash_async(param.new_password), update_time=get_now_UTC_time())
+    # clear try password times and login status
+    await cache_client.del_cache(cache_client.generate_user_operation_key(str(me.id), UserOperation.TRY_PASSWORD), str(me.id))
+    await revoke_user_tokens(me.id)
     return SuccessResponse()
 
 
@@ -188,4 +277,5 @@ async def put_forbbiden_user(param: UserDisablePydantic, me: User = Depends(curr
     user = await User.get_or_none(id=param.user_id)
     user.disabled = param.disabled
     await user.save()
-    return DataResponse(data=UserInfoORMPydantic.model_validate(user))
+    await revoke_user_tokens(user.id)
+    return DataResponse(data=schemas.UserInfoORMPydantic.model_validate(user))
@@ -0,0 +1,56 @@
+"""
+Pick argon2 parameters that hit a target hashing latency on this machine:
+
+    python -m server.module.user.calibrate_password --target-ms 50
+
+Copy the printed block into config.yaml; stored hashes are upgraded on the next login.
+"""
+
+import argparse
+import statistics
+import time
+
+from passlib.hash import argon2
+
+
+def measure(time_cost: int, memory_cost: int, parallelism: int, rounds: int) -> float:
+    """median milliseconds of one hash with the given parameters"""
+    hasher = argon2.using(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        hasher.hash('calibrate-password')
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def calibrate(target_ms: float, memory_cost: int, parallelism: int, rounds: int, max_time_cost: int) -> tuple[int, float]:
+    """raise time_cost until a hash takes at least target_ms, return (time_cost, measured ms)"""
+    elapsed = 0.0
+    for time_cost in range(1, max_time_cost + 1):
+        elapsed = measure(time_cost, memory_cost, parallelism, rounds)
+        print(f'time_cost={time_cost} memory_cost={memory_cost} parallelism={parallelism}: {elapsed:.1f} ms')
+        if elapsed >= target_ms:
+            return time_cost, elapsed
+    return max_time_cost, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target-ms', type=float, default=50, help='target latency of one hash in milliseconds')
+    parser.add_argument('--memory-cost', type=int, default=65536, help='argon2 memory in KiB')
+    parser.add_argument('--parallelism', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=5, help='hashes measured per candidate')
+    parser.add_argument('--max-time-cost', type=int, default=20)
+    args = parser.parse_args()
+
+    time_cost, elapsed = calibrate(args.target_ms, args.memory_cost, args.parallelism, args.rounds, args.max_time_cost)
+    print(f'\n# {elapsed:.1f} ms per hash on this machine')
+    print('password_hash:')
+    print(f'  time_cost: {time_cost}')
+    print(f'  memory_cost: {args.memory_cost}')
+    print(f'  parallelism: {args.parallelism}')
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,7 @@ class User(BaseModel):
     class Meta:
         table = 'tb_user'
         ordering = ('nickname',)
+        indexes = (('nickname', 'id'),)  # keyset pagination of the user list
 
     @property
     def avatar_url(self):
@@ -4,12 +4,22 @@ from typing import Optional
 from pydantic import BaseModel, field_serializer, model_validator
 from tortoise.contrib.pydantic import pydantic_model_creator
 
-from server.module.common.constrants import DEFALT_PASSWORD
 from server.module.user.models import User
-from server.module.user.utils import get_password_hash
 
-UserInfoORMPydantic = pydantic_model_creator(User, name='UserInfoORMPydantic', include=('id', 'nickname', 'phone', 'email', 'role', 'post'))
-UserDetailORMPydantic = pydantic_model_creator(User, name='UserDetailORMPydantic', exclude=('password', 'last_login_ip', 'last_login_time'))
+# ORM pydantic models are created on first access (module __getattr__) instead of at import;
+# use them as schemas.UserInfoORMPydantic so importing this module stays cheap
+_ORM_PYDANTIC_OPTIONS = {
+    'UserInfoORMPydantic': {'include': ('id', 'nickname', 'phone', 'email', 'role', 'post')},
+    'UserDetailORMPydantic': {'exclude': ('password', 'last_login_ip', 'last_login_time')},
+}
+
+
+def __getattr__(name: str):
+    if name not in _ORM_PYDANTIC_OPTIONS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    model = pydantic_model_creator(User, name=name, **_ORM_PYDANTIC_OPTIONS[name])
+    globals()[name] = model
+    return model
 
 
 class UserCreatePydantic(BaseModel):
@@ -22,7 +32,7 @@ class UserCreatePydantic(BaseModel):
 
     @model_validator(mode='after')
     def validate(cls, instance):
-        instance.__dict__['password'] = get_password_hash(instance.password or DEFALT_PASSWORD)
+        # password is hashed in the endpoint, off the event loop
         instance.__dict__['nickname'] = instance.nickname or instance.username
         return instance
 
@@ -84,6 +94,26 @@ class UserPydantic(UserInfoPydantic):
         from_attributes = True
 
 
+class UserListPydantic(BaseModel):
+    id: int
+    key: Optional[int] = None
+    username: str
+    nickname: str | None = None
+    avatar: str | None = None
+    email: str | None = None
+    phone: str | None = None
+    disabled: bool | None = False
+    last_login_ip: Optional[str] = None
+    last_login_time: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+    @field_serializer('key')
+    def serialize_key(self, _):
+        return self.id
+
+
 class UserModifyPasswordPydantic(BaseModel):
     old_password: str
     new_password: str
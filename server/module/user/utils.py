@@ -1,18 +1,69 @@
+import asyncio
+import ipaddress
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import UTC, datetime, timedelta
 from typing import Optional
 
+import orjson
 from fastapi import Depends, Request
+from tortoise.backends.base.client import BaseDBAsyncClient
+from asyncpg.exceptions import DataError
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
-from server.config.settings import ACCESS_TOKEN_EXPIRE_DAYS, ALGORITHM, DEBUG, SECRET_KEY
-from server.module.common.exceptions import AuthorizationFailed
+from server.config.metrics import PASSWORD_HASH_QUEUE_SECONDS, PASSWORD_HASH_REJECTED
+from server.config.settings import (
+    ACCESS_TOKEN_EXPIRE_DAYS,
+    ALGORITHM,
+    DEBUG,
+    PASSWORD_HASH_MAX_PENDING,
+    PASSWORD_HASH_PARAMS,
+    PASSWORD_HASH_WORKERS,
+    SECRET_KEY,
+)
+from server.module.common.db_routing import mark_written, user_scope
+from server.module.common.exceptions import AuthorizationFailed, TooManyRequest
 from server.module.common.global_variable import oauth2_scheme
+from server.module.common.lru_cache import LRUCache
 from server.module.common.redis_client import cache_client
-from server.module.common.utils import get_now_UTC_time
+from server.module.common.utils import dump_model_row, escape_like, get_now_UTC_time, json_dumps, load_model_row
 from server.module.user.models import User
 
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto", **PASSWORD_HASH_PARAMS)
+
+# argon2 releases the GIL, so a small thread pool hashes in parallel without blocking the event loop
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+_password_semaphore: asyncio.Semaphore | None = None
+_password_pending = 0
+
+LAST_SEEN_FLUSH_INTERVAL = 30  # seconds between bulk last-seen updates
+LAST_LOGIN_IP_MAX_LENGTH = User._meta.fields_map['last_login_ip'].max_length
+# user_id -> last seen ip, buffered per worker and written by flush_last_seen
+_last_seen_buffer: dict[int, str] = {}
+_last_seen_task: asyncio.Task | None = None
+
+PRINCIPAL_CACHE_EXPIRE = timedelta(minutes=10)
+PRINCIPAL_CACHE_EXPIRE_SECONDS = PRINCIPAL_CACHE_EXPIRE.total_seconds()
+# short ttl: a revocation from another worker is seen within this many seconds, from the same worker at once
+_local_principal_cache = LRUCache(maxsize=2048, ttl=5)
+# user_id -> ip written by the last flush, the cached principal keeps the older ip until it expires
+_last_seen_flushed = LRUCache(maxsize=4096, ttl=PRINCIPAL_CACHE_EXPIRE_SECONDS)
+
+# must stay identical to the expression of the trigram index in migration 4, otherwise the index is not used
+USER_SEARCH_DOCUMENT = """(coalesce("nickname", '') || ' ' || coalesce("email", '') || ' ' || coalesce("phone", ''))"""
+SEARCH_USERS_SQL = f"""
+SELECT * FROM "tb_user"
+WHERE "username" <> 'admin' AND ({USER_SEARCH_DOCUMENT} ILIKE $1 ESCAPE '\\' OR $2 <% {USER_SEARCH_DOCUMENT})
+ORDER BY word_similarity($2, {USER_SEARCH_DOCUMENT}) DESC, "nickname", "id"
+LIMIT $3
+"""
+
+FLUSH_LAST_SEEN_SQL = """
+UPDATE "tb_user" AS u SET "last_login_ip" = v.ip
+FROM (SELECT unnest($1::bigint[]) AS id, unnest($2::varchar[]) AS ip) AS v
+WHERE u."id" = v.id
+"""
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -28,6 +79,45 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+async def _run_password_task(fn, *args):
+    """run a password hashing call in the bounded executor, reject when too many are already waiting"""
+    global _password_semaphore, _password_pending
+    if _password_semaphore is None:
+        _password_semaphore = asyncio.Semaphore(PASSWORD_HASH_WORKERS)
+    if _password_pending >= PASSWORD_HASH_MAX_PENDING:
+        PASSWORD_HASH_REJECTED.inc()
+        raise TooManyRequest('服务器繁忙, 请稍后重试')
+
+    _password_pending += 1
+    queued_at = time.perf_counter()
+    try:
+        async with _password_semaphore:
+            PASSWORD_HASH_QUEUE_SECONDS.observe(time.perf_counter() - queued_at)
+            return await asyncio.get_running_loop().run_in_executor(_password_executor, fn, *args)
+    finally:
+        _password_pending -= 1
+
+
+def _verify_and_update(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    try:
+        return pwd_context.verify_and_update(plain_password, hashed_password)
+    except:
+        return False, None
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    """
+    Check plain password off the event loop.
+    Also returns a new hash when the stored one uses outdated argon2 parameters, None otherwise.
+    """
+    return await _run_password_task(_verify_and_update, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """Generate password hashed value off the event loop."""
+    return await _run_password_task(pwd_context.hash, password)
+
+
 def create_access_token(user_base_info: dict, expires_delta: Optional[timedelta] = None) -> str:
     """create user access token"""
     if expires_delta:
@@ -57,9 +147,7 @@ async def validate_token(token: str = Depends(oauth2_scheme)) -> str | bool:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("user_id")
         expire_time: float = payload.get('exp')
-        saved_token = await cache_client.get_cache(user_id)
-        check_token = False  # remove new login check: False if DEBUG else saved_token != token
-        if (user_id is None) or (datetime.fromtimestamp(expire_time, tz=UTC) < get_now_UTC_time()) or (check_token):
+        if (user_id is None) or (datetime.fromtimestamp(expire_time, tz=UTC) < get_now_UTC_time()):
             return False
     except JWTError:
         return False
@@ -70,21 +158,168 @@ async def current_user(request: Request, user_base_info: bool | dict = Depends(v
     """return user orm"""
     if user_base_info is False:
         raise AuthorizationFailed()
+    request.state.user_base_info = user_base_info  # reused by LogMiddleware for the access log
     user_id = user_base_info['user_id']
-    await cache_client.expire_cache(user_id, ex=timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
 
-    user = await User.get_or_none(id=user_id, disabled=False).prefetch_related('role', 'user_group')
-    if not user or user.disabled:
+    user, epoch = await get_principal(user_id)
+    # tokens issued before the last logout / password change / disable carry an older epoch
+    if not user or user.disabled or user_base_info.get('epoch', 0) != epoch:
         raise AuthorizationFailed()
 
+    if request.method not in ('GET', 'HEAD'):
+        # the request may write, reads by this user shortly after it stay on the primary
+        await mark_written(user_scope(user_id))
+
     # right = await RightConfig.get_or_none(right_level=user.role)
     # is_allow = await check_api_rights(right, request.url.path)
     # if not is_allow:
     #     raise NoPermission('You are forbbiden.')
 
     if DEBUG:
-        user.last_login_ip = request.client.host
+        mark_last_seen(user, request.client.host)
     else:
-        user.last_login_ip = request.headers.get("X-Forwarded-For")
-    await user.save()
+        mark_last_seen(user, request.headers.get("X-Forwarded-For"))
     return user
+
+
+def _epoch_key(user_id: int | str) -> str:
+    return f'user.epoch.{user_id}'
+
+
+def _principal_key(user_id: int | str) -> str:
+    return f'user.principal.{user_id}'
+
+
+async def get_user_epoch(user_id: int | str) -> int:
+    """current revocation epoch of the user, embedded into newly issued tokens"""
+    return int(await cache_client.get_cache(_epoch_key(user_id)) or 0)
+
+
+async def get_principal(user_id: int | str) -> tuple[Optional[User], int]:
+    """
+    resolve the user behind a token: in-process LRU -> Redis -> database.
+    returns the user (None if missing or disabled) and the current revocation epoch.
+    """
+    cached = _local_principal_cache.get(str(user_id))
+    if cached is None:
+        client = await cache_client.get_redis()
+        pipe = client.pipeline(transaction=False)
+        pipe.get(cache_client.key(_epoch_key(user_id)))
+        pipe.get(cache_client.key(_principal_key(user_id)))
+        epoch, principal = await pipe.execute()
+        epoch = int(epoch or 0)
+        principal = principal and orjson.loads(principal)
+        if principal and principal['epoch'] == epoch:
+            row = principal['row']
+        else:
+            user = await User.get_or_none(id=user_id, disabled=False)
+            row = user and dump_model_row(user)
+            if row:
+                await cache_client.set_cache(
+                    _principal_key(user_id), json_dumps({'epoch': epoch, 'row': row}), PRINCIPAL_CACHE_EXPIRE
+                )
+        cached = (epoch, row)
+        _local_principal_cache.set(str(user_id), cached)
+    epoch, row = cached
+    return (load_model_row(User, row) if row else None), epoch
+
+
+async def invalidate_principal(user_id: int | str) -> None:
+    """drop the cached user after the row changed, tokens stay valid"""
+    _local_principal_cache.pop(str(user_id))
+    await cache_client.del_cache(_principal_key(user_id))
+    await mark_written(user_scope(user_id))
+
+
+async def revoke_user_tokens(user_id: int | str) -> None:
+    """bump the revocation epoch so every token issued so far is rejected immediately"""
+    _local_principal_cache.pop(str(user_id))
+    async with cache_client.pipeline() as pipe:
+        pipe.incr(cache_client.key(_epoch_key(user_id)))
+        pipe.delete(cache_client.key(_principal_key(user_id)))
+    await mark_written(user_scope(user_id))
+
+
+async def search_users(query: str, limit: int, using_db: Optional[BaseDBAsyncClient] = None) -> list[User]:
+    """
+    substring or fuzzy match on nickname/email/phone through the pg_trgm GIN index,
+    best word similarity first
+    """
+    rows = await (using_db or User._meta.db).execute_query_dict(SEARCH_USERS_SQL, [f'%{escape_like(query)}%', query, limit])
+    return [load_model_row(User, row) for row in rows]
+
+
+def normalize_client_ip(ip: Optional[str]) -> Optional[str]:
+    """first hop of an X-Forwarded-For value, None unless it is a valid address that fits tb_user.last_login_ip"""
+    if not ip:
+        return None
+    ip = ip.split(',')[0].strip()
+    try:
+        ip = str(ipaddress.ip_address(ip))
+    except ValueError:
+        return None
+    return ip if len(ip) <= LAST_LOGIN_IP_MAX_LENGTH else None
+
+
+def mark_last_seen(user: User, ip: Optional[str]) -> None:
+    """buffer the user's ip in memory if it changed, instead of saving the whole row on every request"""
+    ip = normalize_client_ip(ip)
+    known_ip = _last_seen_buffer.get(user.id) or _last_seen_flushed.get(user.id) or user.last_login_ip
+    if ip and ip != known_ip:
+        _last_seen_buffer[user.id] = ip
+    if ip:
+        user.last_login_ip = ip
+
+
+async def flush_last_seen() -> None:
+    """write all buffered last-seen ips to tb_user in one UPDATE, touching only last_login_ip"""
+    if not _last_seen_buffer:
+        return
+    pending = dict(_last_seen_buffer)
+    _last_seen_buffer.clear()
+    try:
+        await User._meta.db.execute_query(FLUSH_LAST_SEEN_SQL, [list(pending), list(pending.values())])
+    except Exception:
+        # retry row by row: rows the database rejects are dropped so they can not block later flushes,
+        # on any other error (connection lost...) the remaining rows are kept for the next round
+        pending_rows = list(pending.items())
+        for index, (user_id, ip) in enumerate(pending_rows):
+            try:
+                await User._meta.db.execute_query(FLUSH_LAST_SEEN_SQL, [[user_id], [ip]])
+            except DataError as e:
+                print(f'dropped last seen ip {ip!r} of user {user_id}: {e}')
+                continue
+            except Exception:
+                # keep the values unless a newer one arrived meanwhile
+                for user_id, ip in pending_rows[index:]:
+                    _last_seen_buffer.setdefault(user_id, ip)
+                raise
+            _last_seen_flushed.set(user_id, ip)
+        return
+    for user_id, ip in pending.items():
+        _last_seen_flushed.set(user_id, ip)
+
+
+async def _last_seen_flusher() -> None:
+    while True:
+        await asyncio.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        try:
+            await flush_last_seen()
+        except Exception:
+            from traceback import print_exc
+
+            print_exc()
+
+
+async def start_last_seen_flusher() -> None:
+    global _last_seen_task
+    if _last_seen_task is None:
+        _last_seen_task = asyncio.create_task(_last_seen_flusher())
+
+
+async def stop_last_seen_flusher() -> None:
+    global _last_seen_task
+    if _last_seen_task is not None:
+        _last_seen_task.cancel()
+        _last_seen_task = None
+    await flush_last_seen()
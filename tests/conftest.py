@@ -0,0 +1,20 @@
+"""测试使用仓库中的 config.example.yaml, 不依赖本地未提交的 config.yaml; 必须在导入 server 之前设置"""
+
+import asyncio
+import os
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault('TOPUTILS_CONFIG', str(Path(__file__).resolve().parent.parent / 'config.example.yaml'))
+
+
+@pytest.fixture(scope='session', autouse=True)
+def orm_models():
+    """初始化 Tortoise 模型元数据; 连接池在第一次查询时才建立, 测试把查询替换为假对象, 不会连接数据库"""
+    from tortoise import Tortoise
+
+    from server.config.settings import TORTOISE_ORM
+
+    asyncio.run(Tortoise.init(config=TORTOISE_ORM))
+    yield
@@ -0,0 +1,162 @@
+"""
+发件箱进程的测试: 用 aiosmtpd 在本地起一个需要登录的 SMTP 服务代替真实邮箱, Redis 用内存中的假对象代替。
+"""
+
+import asyncio
+import json
+import os
+import socket
+
+import pytest
+
+pytest.importorskip('aiosmtpd')
+
+from aiosmtpd.controller import Controller  # noqa: E402
+from aiosmtpd.smtp import AuthResult  # noqa: E402
+
+# 先在单进程模式下导入 prometheus_client, 导入 email_worker 时设置的多进程目录不生效, 测试不写指标文件
+import prometheus_client  # noqa: E402, F401
+from redis.exceptions import ConnectionError as RedisConnectionError  # noqa: E402
+
+from server.config import settings  # noqa: E402
+from server.module.common import email_worker  # noqa: E402
+from server.module.common.email_utils import MAIL_DEAD_KEY, MAIL_PROCESSING_KEY, MAIL_RETRY_KEY  # noqa: E402
+
+os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+
+
+class RecordingHandler:
+    def __init__(self) -> None:
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return '250 Message accepted for delivery'
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.lists = {}
+        self.zsets = {}
+
+    async def lpush(self, name, value):
+        self.lists.setdefault(name, []).insert(0, value)
+
+    async def lrem(self, name, count, value):
+        items = self.lists.get(name, [])
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    async def zadd(self, name, mapping):
+        self.zsets.setdefault(name, {}).update(mapping)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def outbox_entry(recipient: str, body='<p>hello</p>', attempts: int = 0) -> str:
+    return json.dumps({'recipients': [recipient], 'subject': 'test', 'body': body, 'attempts': attempts})
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    handler = RecordingHandler()
+    controller = Controller(
+        handler,
+        hostname='127.0.0.1',
+        port=free_port(),
+        authenticator=lambda *_: AuthResult(success=True),
+        auth_require_tls=False,
+    )
+    controller.start()
+    monkeypatch.setattr(settings, 'MAIL_SERVER', controller.hostname)
+    monkeypatch.setattr(settings, 'MAIL_PORT', controller.port)
+    monkeypatch.setattr(settings, 'MAIL_SSL_TLS', False)
+    monkeypatch.setattr(settings, 'MAIL_STARTTLS', False)
+    yield handler
+    controller.stop()
+
+
+def make_worker(batch: list[str]) -> email_worker.EmailOutboxWorker:
+    worker = email_worker.EmailOutboxWorker()
+    worker.redis = FakeRedis()
+    worker.redis.lists[MAIL_PROCESSING_KEY] = list(batch)
+    return worker
+
+
+def test_deliver_sends_batch(smtp_server):
+    batch = [outbox_entry('a@example.com'), outbox_entry('b@example.com')]
+    worker = make_worker(batch)
+
+    async def deliver():
+        await worker.deliver(batch)
+        await worker.disconnect()
+
+    asyncio.run(deliver())
+    assert [envelope.rcpt_tos for envelope in smtp_server.envelopes] == [['a@example.com'], ['b@example.com']]
+    assert worker.redis.lists[MAIL_PROCESSING_KEY] == []
+
+
+def test_deliver_dead_letters_bad_entries_and_continues(smtp_server):
+    malformed = 'not json'
+    unsendable = outbox_entry('a@example.com', body=123)  # set_content 不接受 int
+    batch = [malformed, unsendable, outbox_entry('b@example.com')]
+    worker = make_worker(batch)
+
+    async def deliver():
+        await worker.deliver(batch)
+        await worker.disconnect()
+
+    asyncio.run(deliver())
+    assert [envelope.rcpt_tos for envelope in smtp_server.envelopes] == [['b@example.com']]
+    assert worker.redis.lists[MAIL_DEAD_KEY] == [unsendable, malformed]
+    assert worker.redis.lists[MAIL_PROCESSING_KEY] == []
+
+
+def test_deliver_schedules_retry_when_smtp_is_down(monkeypatch):
+    monkeypatch.setattr(settings, 'MAIL_SERVER', '127.0.0.1')
+    monkeypatch.setattr(settings, 'MAIL_PORT', free_port())  # 没有服务监听, 连接被拒绝
+    monkeypatch.setattr(settings, 'MAIL_SSL_TLS', False)
+    raw = outbox_entry('a@example.com')
+    worker = make_worker([raw])
+
+    asyncio.run(worker.deliver([raw]))
+    (retry,) = worker.redis.zsets[MAIL_RETRY_KEY]
+    assert json.loads(retry)['attempts'] == 1
+    assert worker.redis.lists[MAIL_PROCESSING_KEY] == []
+
+
+def test_run_backs_off_on_redis_errors(monkeypatch):
+    worker = email_worker.EmailOutboxWorker()
+    calls = []
+    sleeps = []
+
+    async def get_redis():
+        return FakeRedis()
+
+    async def recover_processing():
+        calls.append('recover')
+
+    async def run_once():
+        calls.append('run')
+        if calls.count('run') == 1:
+            raise RedisConnectionError('connection lost')
+        worker.stop()
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(email_worker.cache_client, 'get_redis', get_redis)
+    monkeypatch.setattr(worker, 'recover_processing', recover_processing)
+    monkeypatch.setattr(worker, 'run_once', run_once)
+    monkeypatch.setattr(email_worker.asyncio, 'sleep', sleep)
+
+    asyncio.run(worker.run())
+    # Redis 出错后等待, 恢复时把中断的批次放回发件箱
+    assert calls == ['recover', 'run', 'recover', 'run']
+    assert sleeps == [email_worker.ERROR_BACKOFF]
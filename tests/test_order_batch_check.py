@@ -0,0 +1,140 @@
+"""
+批量订阅检查的测试: 订单经订单缓存读取, 开通试用的 UPDATE 行数不足时重新读取订单。
+Redis 和数据库用内存中的假对象代替。
+"""
+
+import asyncio
+from datetime import timedelta
+
+import orjson
+
+from server.module.common.redis_client import cache_client
+from server.module.common.utils import get_now_UTC_time
+from server.module.order import apis, utils
+from server.module.order.models import Order
+from server.module.order.schemas import BatchOrderRequest
+
+
+class FakePipeline:
+    def __init__(self, redis: 'FakeRedis') -> None:
+        self.redis = redis
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        return False
+
+    def set(self, name, value, ex=None):
+        self.redis.data[name] = value if isinstance(value, str) else value.decode()
+
+    async def execute(self):
+        return []
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.data = {}
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+
+class FakeQuery:
+    def __init__(self, db: 'FakeOrderTable', filters: dict) -> None:
+        self.db = db
+        self.filters = filters
+
+    def _rows(self) -> list[Order]:
+        rows = [order for order_id, order in self.db.rows.items() if order_id in self.filters['id__in']]
+        if self.filters.get('expire_time__isnull'):
+            rows = [order for order in rows if order.expire_time is None]
+        return rows
+
+    def using_db(self, connection):
+        return self
+
+    def __await__(self):
+        self.db.reads.append(self.filters['id__in'])
+        return self._copies().__await__()
+
+    async def _copies(self) -> list[Order]:
+        return [Order(**{field: getattr(order, field) for field in Order._meta.fields_db_projection}) for order in self._rows()]
+
+    async def update(self, **values) -> int:
+        rows = self._rows()
+        for order in rows:
+            for field, value in values.items():
+                setattr(order, field, value)
+        return len(rows)
+
+
+class FakeOrderTable:
+    def __init__(self, *orders: Order) -> None:
+        self.rows = {order.id: order for order in orders}
+        self.reads = []
+
+    def filter(self, **filters) -> FakeQuery:
+        return FakeQuery(self, filters)
+
+
+def setup(monkeypatch, *orders: Order) -> tuple[FakeRedis, FakeOrderTable]:
+    redis = FakeRedis()
+    table = FakeOrderTable(*orders)
+
+    async def get_redis():
+        return redis
+
+    monkeypatch.setattr(cache_client, 'client', redis)
+    monkeypatch.setattr(cache_client, 'get_redis', get_redis)
+    monkeypatch.setattr(Order, 'filter', table.filter)
+    utils._local_order_cache.clear()
+    return redis, table
+
+
+def batch_check(*order_ids: str, device_hash: str = 'device') -> dict[str, dict]:
+    request = BatchOrderRequest(orders=[{'order_id': order_id, 'device_hash': device_hash} for order_id in order_ids])
+    response = asyncio.run(apis.batch_check_subscription_status(request))
+    return {item['order_id']: item for item in orjson.loads(response.body)['data']}
+
+
+def make_order(order_id: str, expire_time) -> Order:
+    utc_now = get_now_UTC_time()
+    return Order(
+        id=order_id, tool_id='tool', device_info_hashed='device', expire_time=expire_time, create_time=utc_now, update_time=utc_now, created_at=utc_now
+    )
+
+
+def test_batch_reads_through_order_cache(monkeypatch):
+    expire_time = get_now_UTC_time() + timedelta(days=1)
+    redis, table = setup(monkeypatch, make_order('a', expire_time), make_order('b', expire_time))
+
+    results = batch_check('a', 'b', 'missing')
+    assert results['a']['token'] and results['b']['token']
+    assert results['missing']['error'] == '订单不存在'
+    # 未命中的订单一次 IN 查询读出, 并写入 Redis
+    assert table.reads == [['a', 'b', 'missing']]
+    assert cache_client.key('order.id.a') in redis.data
+
+    # 进程内缓存过期后从 Redis 读取, 只有不存在的订单回源数据库
+    utils._local_order_cache.clear()
+    results = batch_check('a', 'b', 'missing')
+    assert results['a']['token'] and results['b']['token']
+    assert table.reads == [['a', 'b', 'missing'], ['missing']]
+
+
+def test_batch_trial_refetches_orders_not_updated(monkeypatch):
+    # 订单 b 的试用已由并发请求开通且已结束, 缓存中仍是未开通试用的旧数据
+    redis, table = setup(monkeypatch, make_order('a', None), make_order('b', get_now_UTC_time() - timedelta(minutes=1)))
+    asyncio.run(utils.cache_order(make_order('a', None), make_order('b', None)))
+
+    results = batch_check('a', 'b')
+    assert results['a']['token']
+    assert results['b']['error'] == '试用期已结束或订阅过期, 请先续费'
+    assert table.rows['a'].expire_time > get_now_UTC_time()
@@ -0,0 +1,146 @@
+"""
+系统参数缓存的测试: 按名称批量读取与 get_param 共用缓存, 前缀查询的结果写入各参数的缓存, 清除全部参数的缓存。
+Redis 和数据库用内存中的假对象代替。
+"""
+
+import asyncio
+import fnmatch
+
+import pytest
+
+from server.module.common import apis, parameter_cache
+from server.module.common.exceptions import BadRequest
+from server.module.common.models import DataTypeEnum
+from server.module.common.redis_client import cache_client
+
+
+class FakePipeline:
+    def __init__(self, redis: 'FakeRedis') -> None:
+        self.redis = redis
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        return False
+
+    def set(self, name, value, ex=None):
+        self.redis.data[name] = value
+
+    async def execute(self):
+        return []
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.data = {}
+        self.published = []
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def scan_iter(self, match=None, count=None):
+        for key in list(self.data):
+            if fnmatch.fnmatchcase(key, match):
+                yield key
+
+    async def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+class FakeDB:
+    def __init__(self, *rows: dict) -> None:
+        self.rows = rows
+        self.queries = []
+
+    async def execute_query_dict(self, sql, values):
+        names, pattern = values
+        self.queries.append((names, pattern))
+        prefix = pattern and pattern.removesuffix('%')
+        return [row for row in self.rows if row['name'] in names or (prefix and row['name'].startswith(prefix))]
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    redis = FakeRedis()
+    db = FakeDB(
+        {'name': 'client.interval', 'data_type': 'int', 'data': '30'},
+        {'name': 'client.release', 'data_type': 'date', 'data': '2025-06-01'},
+        {'name': 'notice', 'data_type': 'str', 'data': 'hello'},
+    )
+
+    async def get_redis():
+        return redis
+
+    async def read_db(*scopes):
+        return db
+
+    monkeypatch.setattr(cache_client, 'get_redis', get_redis)
+    monkeypatch.setattr(parameter_cache, 'read_db', read_db)
+    parameter_cache._local_param_cache.clear()
+    return redis, db
+
+
+def test_fetch_params_by_name_uses_param_cache(fakes):
+    redis, db = fakes
+
+    params = asyncio.run(parameter_cache.fetch_params(['notice', 'client.interval', 'missing']))
+    assert params == {'client.interval': 30, 'notice': 'hello'}
+    assert db.queries == [(['notice', 'client.interval', 'missing'], None)]
+    assert redis.data[cache_client.key('param.missing')] == 'null'
+
+    # 同一批参数再次读取命中进程内缓存, get_param 也不再查库
+    assert asyncio.run(parameter_cache.fetch_params(['client.interval', 'notice'])) == params
+    assert asyncio.run(parameter_cache.get_param('notice')) == 'hello'
+    # 进程内缓存失效后从 Redis 读取
+    parameter_cache._local_param_cache.clear()
+    assert asyncio.run(parameter_cache.fetch_params(['client.interval', 'missing'])) == {'client.interval': 30}
+    assert len(db.queries) == 1
+
+
+def test_fetch_params_by_prefix_warms_param_cache(fakes):
+    redis, db = fakes
+
+    params = asyncio.run(parameter_cache.fetch_params(prefix='client.'))
+    assert list(params) == ['client.interval', 'client.release']
+    assert str(params['client.release']) == '2025-06-01'
+    assert asyncio.run(parameter_cache.get_param('client.interval')) == 30
+    assert len(db.queries) == 1
+
+
+def test_invalidate_all_params_clears_redis(fakes):
+    redis, db = fakes
+    asyncio.run(parameter_cache.fetch_params(['notice', 'missing']))
+    redis.data[cache_client.key('order.id.1')] = '{}'
+
+    asyncio.run(parameter_cache.invalidate_param())
+    assert list(redis.data) == [cache_client.key('order.id.1')]
+    assert redis.published == [(cache_client.key(parameter_cache.PARAM_INVALIDATE_CHANNEL), parameter_cache.PARAM_INVALIDATE_ALL)]
+    # 进程内和 Redis 中的缓存都已清除, 再次读取回源数据库
+    asyncio.run(parameter_cache.get_param('notice'))
+    assert len(db.queries) == 2
+
+
+@pytest.mark.parametrize(
+    'data_type, data',
+    [
+        (DataTypeEnum.INTEGER, '1.5'),
+        (DataTypeEnum.JSON, '{'),
+        (DataTypeEnum.DATE, '2025-13-01'),
+        (DataTypeEnum.DATETIME, '2025-06-01'),
+    ],
+)
+def test_validate_param_data_rejects_unparsable_data(data_type, data):
+    with pytest.raises(BadRequest):
+        apis.validate_param_data(data_type, data)
+
+
+def test_validate_param_data_accepts_dates():
+    apis.validate_param_data(DataTypeEnum.DATE, '2025-06-01')
+    apis.validate_param_data(DataTypeEnum.DATETIME, '2025-06-01 12:00:00')
@@ -0,0 +1,62 @@
+"""
+get_principal 缓存未命中路径的回归测试: 从数据库读出用户后写入 Redis, 再次读取不再查库。
+Redis 和数据库用内存中的假对象代替, 配置由 conftest 指向 config.example.yaml。
+"""
+
+import asyncio
+
+import orjson
+
+from server.module.common.redis_client import cache_client
+from server.module.user import utils
+from server.module.user.models import User
+
+
+class FakePipeline:
+    def __init__(self, redis: 'FakeRedis') -> None:
+        self.redis = redis
+        self.keys = []
+
+    def get(self, key):
+        self.keys.append(key)
+
+    async def execute(self):
+        return [self.redis.data.get(key) for key in self.keys]
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.data = {}
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    async def set(self, name, value, ex=None):
+        self.data[name] = value if isinstance(value, str) else value.decode()
+        return True
+
+
+def test_get_principal_cache_miss_writes_redis(monkeypatch):
+    redis = FakeRedis()
+    db_reads = []
+
+    async def get_redis():
+        return redis
+
+    async def get_or_none(**filters):
+        db_reads.append(filters)
+        return User(id=1, nickname='nick', username='user', password='hashed')
+
+    monkeypatch.setattr(cache_client, 'client', redis)
+    monkeypatch.setattr(cache_client, 'get_redis', get_redis)
+    monkeypatch.setattr(User, 'get_or_none', get_or_none)
+    utils._local_principal_cache.clear()
+
+    user, epoch = asyncio.run(utils.get_principal(1))
+    assert user.username == 'user' and epoch == 0
+    assert orjson.loads(redis.data[cache_client.key('user.principal.1')])['row']['username'] == 'user'
+
+    # 进程内缓存失效后从 Redis 读取, 不再查库
+    utils._local_principal_cache.clear()
+    user, epoch = asyncio.run(utils.get_principal(1))
+    assert user.username == 'user' and len(db_reads) == 1